@@ -0,0 +1,115 @@
+"""Times the due AsyncJob queries against a large async_job table.
+
+Builds a SQLite database of mostly historic (completed) jobs with a few
+due ones, then times the due queries with and without the
+ix__async_job__scheduled__job_type index.
+
+    python benchmarks/async_job_due_query.py --rows 1000000 --due 1000
+"""
+import argparse
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from flask import Flask
+from sqlalchemy import insert, text
+from lbrc_flask.database import db
+from lbrc_flask.async_jobs import AsyncJob, AsyncJobs
+
+
+INDEX_NAME = 'ix__async_job__scheduled__job_type'
+
+
+def populate(rows, due, chunk_size=50_000):
+    now = datetime.now(timezone.utc)
+
+    for start in range(0, rows, chunk_size):
+        values = []
+
+        for i in range(start, min(start + chunk_size, rows)):
+            if i < due:
+                scheduled = now - timedelta(minutes=i % 60 + 1)
+            elif i % 20 == 0:
+                scheduled = now + timedelta(hours=i % 48 + 1)
+            else:
+                scheduled = None
+
+            values.append({
+                'job_type': 'generic',
+                'entity_id': i,
+                'scheduled': scheduled,
+                'last_executed': now - timedelta(days=i % 365),
+                'error': '',
+                'retry': False,
+            })
+
+        db.session.execute(insert(AsyncJob), values)
+        db.session.commit()
+
+    db.session.execute(text('ANALYZE'))
+    db.session.commit()
+
+
+def timed(f, repeat):
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def measure(repeat):
+    def first_batch():
+        next(AsyncJobs.due_batches(batch_size=100), None)
+        db.session.rollback()
+
+    def all_batches():
+        for _ in AsyncJobs.due_batches(batch_size=100, expunge=True):
+            pass
+        db.session.rollback()
+
+    return {
+        'due_count': timed(AsyncJobs.due_count, repeat),
+        'first batch of 100': timed(first_batch, repeat),
+        'all due in batches': timed(all_batches, repeat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--due', type=int, default=1_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{Path(directory) / "jobs.db"}'
+        db.init_app(app)
+
+        with app.app_context():
+            db.create_all()
+
+            start = time.perf_counter()
+            populate(args.rows, args.due)
+            print(f'Populated {args.rows:,} rows ({args.due:,} due) in {time.perf_counter() - start:.1f}s')
+
+            with_index = measure(args.repeat)
+
+            db.session.execute(text(f'DROP INDEX {INDEX_NAME}'))
+            db.session.commit()
+
+            without_index = measure(args.repeat)
+
+            print(f'{"query":<24}{"indexed ms":>14}{"no index ms":>14}')
+
+            for name in with_index:
+                print(f'{name:<24}{with_index[name] * 1000:>14.2f}{without_index[name] * 1000:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Compares tasks per second with and without CELERY_REUSE_APP_CONTEXT.
+
+Calls a tiny task the way a worker does, in a thread with no app context,
+so that only the cost of the task's app context handling differs.
+
+    python benchmarks/celery_app_context.py --tasks 20000
+"""
+import argparse
+import threading
+import time
+from celery import Celery
+from flask import Flask, g
+from sqlalchemy import text
+from lbrc_flask.celery import _context_task
+from lbrc_flask.database import db
+
+
+def create_task(reuse_app_context):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['CELERY_RATE_LIMIT'] = ''
+    app.config['CELERY_REUSE_APP_CONTEXT'] = reuse_app_context
+    db.init_app(app)
+
+    benchmark_celery = Celery()
+    benchmark_celery.Task = _context_task(benchmark_celery.Task, app)
+
+    @benchmark_celery.task()
+    def tiny(with_query):
+        g.value = 1
+
+        if with_query:
+            db.session.execute(text('SELECT 1'))
+
+    return tiny
+
+
+def tasks_per_second(task, count, with_query):
+    result = {}
+
+    def run():
+        task(with_query)
+
+        start = time.perf_counter()
+
+        for _ in range(count):
+            task(with_query)
+
+        result['value'] = count / (time.perf_counter() - start)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+
+    return result['value']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=20_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"task":<20}{"per task ctx":>16}{"reused ctx":>16}{"speed up":>10}')
+
+    for with_query in [False, True]:
+        per_task = max(tasks_per_second(create_task(False), args.tasks, with_query) for _ in range(args.repeat))
+        reused = max(tasks_per_second(create_task(True), args.tasks, with_query) for _ in range(args.repeat))
+        name = 'SELECT 1' if with_query else 'set g'
+
+        print(f'{name:<20}{per_task:>16,.0f}{reused:>16,.0f}{reused / per_task:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
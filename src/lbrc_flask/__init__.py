@@ -1,4 +1,5 @@
 from flask import Blueprint, g
+from .caching import init_caching
 from .database import db
 from .emailing import init_mail
 from .standard_views import init_standard_views
@@ -22,6 +23,7 @@ def init_lbrc_flask(app, title):
     init_mail(app)
     init_standard_views(app)
     init_template_filters(app)
+    init_caching(app)
 
     @app.before_request
     def get_current_user():
@@ -1,11 +1,12 @@
-from flask_admin import AdminIndexView, Admin, expose
+from datetime import datetime, timedelta, timezone
+from flask_admin import AdminIndexView, Admin, BaseView, expose
 from flask import current_app, abort, redirect, url_for, request
 from flask_security import current_user
 from flask_admin.contrib.sqla import ModelView
 from flask_security import roles_accepted
 
 
-class AdminCustomView(ModelView):
+class AdminAccessMixin:
     def is_accessible(self):
         return (
             current_user.is_active
@@ -27,6 +28,30 @@ class AdminCustomView(ModelView):
                 return redirect(url_for("security.login", next=request.url))
 
 
+class AdminCustomView(AdminAccessMixin, ModelView):
+    pass
+
+
+class AsyncJobStatisticsView(AdminAccessMixin, BaseView):
+    max_hours = 24 * 366
+
+    @expose('/')
+    def index(self):
+        from lbrc_flask.async_jobs import AsyncJobs
+
+        hours = min(max(request.args.get('hours', 24, type=int), 1), self.max_hours)
+
+        return self.render(
+            'admin/async_job_statistics.html',
+            hours=hours,
+            max_hours=self.max_hours,
+            statistics=AsyncJobs.statistics(since=datetime.now(timezone.utc) - timedelta(hours=hours)),
+            due_count=AsyncJobs.due_count(),
+            due_lag=AsyncJobs.due_lag(),
+            running=AsyncJobs.running_counts(),
+        )
+
+
 class AdminHomeView(AdminIndexView):
     @roles_accepted('admin')
     @expose('/')
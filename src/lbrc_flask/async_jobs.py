@@ -1,8 +1,24 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, nullcontext
+import atexit
 from datetime import datetime, timedelta, timezone
+from functools import partial
 import logging
+import multiprocessing
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from flask import current_app
+from celery import chord, group
 from lbrc_flask.celery import celery
 from lbrc_flask.database import db
-from sqlalchemy import Boolean, DateTime, Integer, String, UnicodeText, UniqueConstraint, select, func
+from sqlalchemy import Boolean, DateTime, Float, Index, Integer, String, UnicodeText, UniqueConstraint, select, func, update, insert, case, literal, and_, or_, false, text
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from sqlalchemy.orm import Mapped, mapped_column
 from lbrc_flask.logging import log_exception
 
@@ -10,15 +26,38 @@ from lbrc_flask.logging import log_exception
 class AsyncJob(db.Model):
     __table_args__ = (
         UniqueConstraint("job_type", "entity_id", "entity_id_string", name='ux__async_job__job_type__entity'),
+        Index('ix__async_job__scheduled__job_type', 'scheduled', 'job_type'),
     )
     __mapper_args__ = {
         "polymorphic_identity": "generic",
         "polymorphic_on": "job_type",
     }
 
+    TIMEDELTA_SECONDS = 'seconds'
+    TIMEDELTA_MINUTES = 'minutes'
     TIMEDELTA_HOURS = 'hours'
     TIMEDELTA_DAYS = 'days'
 
+    # With retry_backoff, the retry period doubles after each failed attempt
+    # up to retry_backoff_cap, and up to retry_jitter of it is taken off at
+    # random so that jobs that failed together do not all retry together.
+    retry_backoff_cap = timedelta(days=1)
+    retry_jitter = 0.25
+
+    # Higher priority job types are run first.  A max_concurrent limits the
+    # number of jobs of the type that may be running at once, e.g., for jobs
+    # that call a rate limited service.  Both may be overridden by the
+    # ASYNC_JOBS_PRIORITIES and ASYNC_JOBS_MAX_CONCURRENT config settings.
+    priority = 0
+    max_concurrent = None
+
+    # With a coalesce_window, a job is run that long after it is first
+    # scheduled, and scheduling it again before then does not move the run,
+    # so that a burst of changes to an entity results in a single run.  May
+    # be overridden by the ASYNC_JOBS_COALESCE_WINDOWS config setting, in
+    # seconds.
+    coalesce_window = None
+
     id: Mapped[Integer] = mapped_column(Integer, primary_key=True, nullable=False)
     job_type: Mapped[String] = mapped_column(String(100), nullable=False)
     entity_id: Mapped[Integer] = mapped_column(Integer, nullable=True)
@@ -29,33 +68,107 @@ class AsyncJob(db.Model):
     retry: Mapped[Boolean] = mapped_column(Boolean, nullable=False, default=False)
     retry_timedelta_period: Mapped[String] = mapped_column(String(10), nullable=True)
     retry_timedelta_size: Mapped[Integer] = mapped_column(Integer, nullable=True)
+    retry_backoff: Mapped[Boolean] = mapped_column(Boolean, nullable=False, default=False, server_default=false())
+    attempts: Mapped[Integer] = mapped_column(Integer, nullable=False, default=0, server_default='0')
+    max_attempts: Mapped[Integer] = mapped_column(Integer, nullable=True)
+    dead: Mapped[Boolean] = mapped_column(Boolean, nullable=False, default=False, server_default=false())
+    claimed_by: Mapped[String] = mapped_column(String(100), nullable=True)
+    lease_expires: Mapped[DateTime] = mapped_column(DateTime, nullable=True)
 
     def run(self):
+        run = _JobRun(self)
+
         try:
-            self._run_actual()
+            with self._heartbeat():
+                self._execute()
+        except Exception as e:
+            return self._failed(run, e)
+
+        return self._succeeded(run)
 
+    def _execute(self):
+        self._run_actual()
+
+    def _succeeded(self, run):
+        try:
             self.error = ''
+            self.attempts = 0
+            self.dead = False
 
             self.last_executed = datetime.now(timezone.utc)
             self.scheduled = None
+            self.claimed_by = None
+            self.lease_expires = None
 
             db.session.add(self)
+            self._record_run(run, succeeded=True)
             db.session.commit()
 
+            return True
+
         except Exception as e:
-            logging.error(f'Error processing {self}')
-            log_exception(e)
-            logging.warning('Rolling back transaction')
-            db.session.rollback()
+            return self._failed(run, e)
 
-            self.error = str(e)
+    def _failed(self, run, e):
+        logging.error(f'Error processing {self}')
+        log_exception(e)
+        logging.warning('Rolling back transaction')
+        db.session.rollback()
 
-            if self.retry and self.retry_timedelta_period and self.retry_timedelta_size:
-                self.scheduled = datetime.now(timezone.utc) + self.__retry_timedelta()
+        self.error = str(e)
+        self.attempts = (self.attempts or 0) + 1
 
-            self.last_executed = datetime.now(timezone.utc)
-            db.session.add(self)
-            db.session.commit()
+        if self.max_attempts and self.attempts >= self.max_attempts:
+            logging.warning(f'Job has failed {self.attempts} times and will not be retried: {self}')
+            self.dead = True
+            self.scheduled = None
+        elif self.retry and self.retry_timedelta_period and self.retry_timedelta_size:
+            self.scheduled = datetime.now(timezone.utc) + self.retry_delay()
+
+        self.last_executed = datetime.now(timezone.utc)
+        self.claimed_by = None
+        self.lease_expires = None
+        db.session.add(self)
+        self._record_run(run, succeeded=False)
+        db.session.commit()
+
+        return False
+
+    def heartbeat(self, lease=None):
+        # Extends the lease on a claimed job, and the rest of its claim,
+        # outside of the session's transaction, to show that the worker
+        # running it is still alive.  Returns False if the job is no longer
+        # claimed by that worker.
+        return _extend_lease(db.engine, self.id, self.claimed_by, lease or AsyncJobs.heartbeat_lease())
+
+    def _heartbeat(self):
+        interval = current_app.config.get('ASYNC_JOBS_HEARTBEAT_SECONDS')
+
+        if self.claimed_by and interval:
+            return _Heartbeat(db.engine, self.id, self.claimed_by, interval)
+        else:
+            return nullcontext()
+
+    def _record_run(self, run, succeeded):
+        if not current_app.config.get('ASYNC_JOBS_TELEMETRY', True):
+            return
+
+        queue_lag = None
+
+        if run.scheduled:
+            queue_lag = (run.started - _as_utc(run.scheduled)).total_seconds()
+
+        db.session.add(AsyncJobRun(
+            async_job_id=self.id,
+            job_type=self.job_type,
+            attempt=run.attempt,
+            started=run.started,
+            ended=datetime.now(timezone.utc),
+            duration=run.duration(),
+            queue_lag=queue_lag,
+            succeeded=succeeded,
+            error=self.error or None,
+        ))
 
     def scheduled_before_rerun(self):
         if not self.scheduled or not self.last_executed:
@@ -63,13 +176,33 @@ class AsyncJob(db.Model):
         else:
             return self.scheduled.astimezone(timezone.utc) < (self.last_executed.astimezone(timezone.utc) + self.__retry_timedelta())
 
+    def rerun_cutoff(self):
+        # A job last executed after this time has been run too recently to
+        # be rescheduled.  The SQL equivalent of scheduled_before_rerun.
+        if self.scheduled:
+            return self.scheduled - self.__retry_timedelta()
+
+    def retry_delay(self):
+        result = self.__retry_timedelta()
+
+        if self.retry_backoff:
+            exponent = min(max((self.attempts or 1) - 1, 0), 64)
+            seconds = min(result.total_seconds() * 2 ** exponent, self.retry_backoff_cap.total_seconds())
+            seconds -= seconds * self.retry_jitter * random.random()
+            result = timedelta(seconds=seconds)
+
+        return result
+
     def __retry_timedelta(self):
         params = {}
 
-        if self.retry_timedelta_period == AsyncJob.TIMEDELTA_HOURS:
-            params = {'hours': int(self.retry_timedelta_size)}
-        elif self.retry_timedelta_period == AsyncJob.TIMEDELTA_DAYS:
-            params = {'days': int(self.retry_timedelta_size)}
+        if self.retry_timedelta_period in [
+            AsyncJob.TIMEDELTA_SECONDS,
+            AsyncJob.TIMEDELTA_MINUTES,
+            AsyncJob.TIMEDELTA_HOURS,
+            AsyncJob.TIMEDELTA_DAYS,
+        ]:
+            params = {self.retry_timedelta_period: int(self.retry_timedelta_size)}
         
         return timedelta(**params)
     
@@ -86,26 +219,976 @@ class AsyncJob(db.Model):
         result.append(f'entity_id = {self.entity_id}')
         result.append(f'entity_id_string = {self.entity_id_string}')
         result.append(f'scheduled = {self.scheduled}')
+        result.append(f'claimed_by = {self.claimed_by}')
+        result.append(f'attempts = {self.attempts}')
         return '{' + '; '.join(result) + '}'
 
 
+class AsyncIOJob(AsyncJob):
+    # A job whose _run_actual is a coroutine, for jobs that spend most of
+    # their time waiting on I/O.  A batch of them is run at once on one event
+    # loop, at most ASYNC_JOBS_ASYNCIO_CONCURRENCY at a time.
+    #
+    # The coroutines share the database session, so they should not use it.
+    # Whatever _run_actual returns is passed to _save, which is called once
+    # the coroutine has finished, one job at a time, to write the results.
+    __abstract__ = True
+
+    async def _run_actual(self):
+        raise Exception("Generic AsyncIOJob is not defined")
+
+    def _save(self, result):
+        pass
+
+    def _execute(self):
+        self._save(asyncio.run(self._run_actual()))
+
+
+def _run_asyncio_jobs(jobs, concurrency, report):
+    async def run_one(semaphore, job):
+        async with semaphore:
+            run = _JobRun(job)
+
+            try:
+                logging.info(f'Running job: {job}')
+                return run, True, await job._run_actual()
+            except Exception as e:
+                return run, False, e
+            finally:
+                run.finished()
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(*[run_one(semaphore, j) for j in jobs])
+
+    # The whole claim is heartbeated while the batch runs, as the jobs
+    # do not heartbeat themselves when run on the event loop.
+    with jobs[0]._heartbeat() if jobs else nullcontext():
+        results = asyncio.run(run_all())
+
+    for job, (run, completed, result) in zip(jobs, results):
+        job_id = job.id
+
+        if completed:
+            try:
+                job._save(result)
+            except Exception as e:
+                report.add(job._failed(run, e), job_id)
+                continue
+
+            report.add(job._succeeded(run), job_id)
+        else:
+            report.add(job._failed(run, result), job_id)
+
+
+class _JobRun:
+    # Timings of a single run of a job, taken before it starts
+    def __init__(self, job):
+        self.started = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.finish = None
+        self.scheduled = job.scheduled
+        self.attempt = (job.attempts or 0) + 1
+
+    def finished(self):
+        self.finish = time.perf_counter()
+
+    def duration(self):
+        return (self.finish or time.perf_counter()) - self.start
+
+
+class AsyncJobRun(db.Model):
+    # One row per execution of an AsyncJob.  Not a foreign key, so that the
+    # history outlives the job.
+    __table_args__ = (
+        Index('ix__async_job_run__started__job_type', 'started', 'job_type'),
+    )
+
+    id: Mapped[Integer] = mapped_column(Integer, primary_key=True, nullable=False)
+    async_job_id: Mapped[Integer] = mapped_column(Integer, nullable=False, index=True)
+    job_type: Mapped[String] = mapped_column(String(100), nullable=False)
+    attempt: Mapped[Integer] = mapped_column(Integer, nullable=False, default=1, server_default='1')
+    started: Mapped[DateTime] = mapped_column(DateTime, nullable=False)
+    ended: Mapped[DateTime] = mapped_column(DateTime, nullable=False)
+    duration: Mapped[Float] = mapped_column(Float, nullable=False)
+    queue_lag: Mapped[Float] = mapped_column(Float, nullable=True)
+    succeeded: Mapped[Boolean] = mapped_column(Boolean, nullable=False)
+    error: Mapped[UnicodeText] = mapped_column(UnicodeText, nullable=True)
+
+
+class AsyncJobArchive(db.Model):
+    # Completed jobs moved out of async_job once past the retention period
+    id: Mapped[Integer] = mapped_column(Integer, primary_key=True, nullable=False)
+    async_job_id: Mapped[Integer] = mapped_column(Integer, nullable=False, index=True)
+    job_type: Mapped[String] = mapped_column(String(100), nullable=False)
+    entity_id: Mapped[Integer] = mapped_column(Integer, nullable=True)
+    entity_id_string: Mapped[String] = mapped_column(String(255), nullable=True)
+    last_executed: Mapped[DateTime] = mapped_column(DateTime, nullable=True)
+    archived: Mapped[DateTime] = mapped_column(DateTime, nullable=False, server_default=func.current_timestamp())
+
+
+def _completed_before_criteria(cutoff):
+    # Jobs that last succeeded before the cutoff and are not scheduled again
+    return [
+        AsyncJob.scheduled == None,
+        AsyncJob.claimed_by == None,
+        AsyncJob.dead == False,
+        AsyncJob.error == '',
+        AsyncJob.last_executed < cutoff,
+    ]
+
+
+def _extend_lease(engine, job_id, claimed_by, lease):
+    # Extends the lease on every job in the worker's claim, so that jobs
+    # waiting behind the running one are not reaped either.  Nothing is
+    # extended if the running job itself is no longer claimed.  The waiting
+    # jobs' leases are never shortened, as a claim fanned out in chunks may
+    # have jobs with a longer lease waiting to be picked up by another worker.
+    table = AsyncJob.__table__
+    lease_expires = datetime.now(timezone.utc) + lease
+
+    with engine.begin() as conn:
+        if conn.execute(
+            update(table)
+            .where(table.c.id == job_id)
+            .where(table.c.claimed_by == claimed_by)
+            .values(lease_expires=lease_expires)
+        ).rowcount != 1:
+            return False
+
+        conn.execute(
+            update(table)
+            .where(table.c.claimed_by == claimed_by)
+            .where(table.c.id != job_id)
+            .where(table.c.lease_expires < lease_expires)
+            .values(lease_expires=lease_expires)
+        )
+
+        return True
+
+
+def _confirm_claim(job_id, claimed_by, lease):
+    # Renews the lease of a claimed job just before it is run.  No row is
+    # updated if the claim has been reaped, and perhaps taken by another
+    # worker, while the job was waiting, and then the job must not be run.
+    confirmed = db.session.execute(
+        update(AsyncJob)
+        .where(AsyncJob.id == job_id)
+        .where(AsyncJob.claimed_by == claimed_by)
+        .values(lease_expires=datetime.now(timezone.utc) + lease)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+    db.session.commit()
+
+    if not confirmed:
+        logging.warning(f'Job {job_id} is no longer claimed by {claimed_by}')
+
+    return confirmed
+
+
+def _release_claims(job_ids, claimed_by):
+    # Jobs that were claimed but will not be run are due again straight
+    # away, rather than when their lease runs out.
+    if not job_ids:
+        return
+
+    db.session.rollback()
+    db.session.execute(
+        update(AsyncJob)
+        .where(AsyncJob.id.in_(job_ids))
+        .where(AsyncJob.claimed_by == claimed_by)
+        .values(claimed_by=None, lease_expires=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+class _Heartbeat:
+    # Extends the lease of a running job, and the rest of its worker's
+    # claim, every interval seconds from a background thread.  The lease
+    # is three intervals long, so a job whose worker has died is reaped
+    # after a few minutes, rather than when the lease taken when it was
+    # claimed runs out.
+    def __init__(self, engine, job_id, claimed_by, interval):
+        self.engine = engine
+        self.job_id = job_id
+        self.claimed_by = claimed_by
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._beat, name=f'async_job_heartbeat_{job_id}', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopped.set()
+        self._thread.join()
+
+    def _beat(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                if not _extend_lease(self.engine, self.job_id, self.claimed_by, timedelta(seconds=self.interval * 3)):
+                    logging.warning(f'Job {self.job_id} is no longer claimed by {self.claimed_by}')
+                    return
+            except Exception as e:
+                log_exception(e)
+
+
+def _as_utc(value):
+    # Naive datetimes read back from the database were stored as UTC
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    else:
+        return value.astimezone(timezone.utc)
+
+
+def _run_percentile(since, job_type, column, count, percent):
+    # Nearest rank percentile of the count non-null values of column.  Only
+    # the value at that rank is read, rather than every run.
+    if not count:
+        return None
+
+    return db.session.execute(
+        select(column)
+        .where(AsyncJobRun.started >= since)
+        .where(AsyncJobRun.job_type == job_type)
+        .where(column != None)
+        .order_by(column)
+        .offset(max(0, min(count - 1, round(percent / 100 * count) - 1)))
+        .limit(1)
+    ).scalar()
+
+
+class JobBatchReport:
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = 0
+        self.seconds = 0
+        self.job_ids = []
+
+    def add(self, succeeded, job_id=None):
+        if job_id is not None:
+            self.job_ids.append(job_id)
+
+        if succeeded:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+
+    def extend(self, other):
+        self.succeeded += other.succeeded
+        self.failed += other.failed
+        self.job_ids.extend(other.job_ids)
+
+    @property
+    def total(self):
+        return self.succeeded + self.failed
+
+    def as_dict(self):
+        return {
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'seconds': self.seconds,
+        }
+
+    @property
+    def jobs_per_second(self):
+        if self.seconds:
+            return self.total / self.seconds
+
+    def __str__(self):
+        return f'{self.total} jobs ({self.succeeded} succeeded, {self.failed} failed) in {self.seconds:.2f}s'
+
+
+def _past_deadline(deadline):
+    # Deadlines are taken from time.monotonic(), which forked workers share
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _run_job_in_app_context(app, claimed_by, lease, deadline, job_id):
+    # Each job gets its own app context and so its own scoped session.
+    # Returns None if the job was not run because the deadline had passed
+    # or its claim was lost.
+    if _past_deadline(deadline):
+        return None
+
+    with app.app_context():
+        if not _confirm_claim(job_id, claimed_by, lease):
+            return None
+
+        job = db.session.get(AsyncJob, job_id)
+        logging.info(f'Running job: {job}')
+        return job.run()
+
+
+# The process pool is forked, so the application is handed to each
+# worker's initializer without being pickled.  Only the workers set this.
+_process_app = None
+
+
+def _init_process_worker(app):
+    global _process_app
+
+    # Connections inherited from the parent process must not be used
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+    _process_app = app
+
+
+def _run_job_in_process(claimed_by, lease, deadline, job_id):
+    return _run_job_in_app_context(_process_app, claimed_by, lease, deadline, job_id)
+
+
+def _process_pool_unavailable():
+    # Daemonic processes, such as celery prefork workers, may not have
+    # children.  Forks are also kept to the main thread, away from the
+    # thread dispatcher's drains.
+    #
+    # That does not make forking safe: a fork copies only the calling
+    # thread, so a lock held by any other thread at that moment (a
+    # heartbeat, a dispatcher or the pool's own manager thread) is copied
+    # held and may deadlock a worker.  The pool is forked once and reused
+    # to keep that window small, but the process executor is meant for a
+    # dedicated worker process that runs little else.
+    if multiprocessing.current_process().daemon:
+        return 'in a daemonic process'
+
+    if threading.current_thread() is not threading.main_thread():
+        return 'off the main thread'
+
+
+_PROCESS_POOL_EXTENSION = 'lbrc_flask.async_job_process_pool'
+_process_pool_lock = threading.Lock()
+
+
+def _process_pool(app, max_workers):
+    # The workers are forked once and reused for every batch.  A pool
+    # inherited from a parent process, or of the wrong size, is replaced.
+    with _process_pool_lock:
+        pid, workers, pool = app.extensions.get(_PROCESS_POOL_EXTENSION, (None, None, None))
+
+        if pid != os.getpid() or workers != max_workers:
+            if pid == os.getpid():
+                pool.shutdown(wait=False)
+
+            pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_process_worker,
+                initargs=(app,),
+            )
+            atexit.register(pool.shutdown)
+            app.extensions[_PROCESS_POOL_EXTENSION] = (os.getpid(), max_workers, pool)
+
+        return pool
+
+
+def _discard_process_pool(app, pool):
+    with _process_pool_lock:
+        if app.extensions.get(_PROCESS_POOL_EXTENSION, (None, None, None))[2] is pool:
+            del app.extensions[_PROCESS_POOL_EXTENSION]
+
+    pool.shutdown(wait=False)
+
+
+@contextmanager
+def _job_type_locks(job_types):
+    # Serialises claims of job types with a concurrency limit, so that
+    # workers claiming at the same time do not all see the same running
+    # count.  The locks are held on a connection of their own until the
+    # claim is committed.  SQLite has a single writer, so checking the
+    # count again after the claim's update is enough there.
+    dialect = db.engine.dialect.name
+    names = [f'lbrc_flask.async_job.{t}'[:64] for t in sorted(job_types)]
+
+    if not names or dialect not in ['mysql', 'mariadb', 'postgresql']:
+        yield
+        return
+
+    if dialect == 'postgresql':
+        lock, unlock = 'SELECT pg_advisory_lock(hashtext(:name))', 'SELECT pg_advisory_unlock(hashtext(:name))'
+    else:
+        lock, unlock = 'SELECT GET_LOCK(:name, 60)', 'SELECT RELEASE_LOCK(:name)'
+
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        locked = []
+
+        try:
+            for name in names:
+                if conn.execute(text(lock), {'name': name}).scalar() == 0:
+                    raise TimeoutError(f'Timed out waiting for the async job claim lock {name}')
+
+                locked.append(name)
+
+            yield
+        finally:
+            for name in reversed(locked):
+                conn.execute(text(unlock), {'name': name})
+
+
+def _release_over_max_concurrent(claim_id, max_concurrent, job_types, now):
+    # Another worker may have claimed jobs of the same type since the
+    # running count was read.  Any of this claim's jobs over the limit
+    # are released again before the claim is committed.
+    for job_type in job_types & max_concurrent.keys():
+        running = db.session.execute(
+            select(func.count(AsyncJob.id))
+            .where(AsyncJob.job_type == job_type)
+            .where(AsyncJob.claimed_by != None)
+            .where(AsyncJob.lease_expires >= now)
+        ).scalar()
+
+        excess = running - max_concurrent[job_type]
+
+        if excess > 0:
+            excess_ids = db.session.execute(
+                select(AsyncJob.id)
+                .where(AsyncJob.claimed_by == claim_id)
+                .where(AsyncJob.job_type == job_type)
+                .order_by(AsyncJob.scheduled.desc(), AsyncJob.id.desc())
+                .limit(excess)
+            ).scalars().all()
+
+            db.session.execute(
+                update(AsyncJob)
+                .where(AsyncJob.id.in_(excess_ids))
+                .values(claimed_by=None, lease_expires=None)
+                .execution_options(synchronize_session=False)
+            )
+
+
+def _due_criteria(now):
+    # Jobs claimed by a worker are not due until the worker's lease runs out
+    return [
+        AsyncJob.scheduled < now,
+        or_(AsyncJob.lease_expires == None, AsyncJob.lease_expires < now),
+    ]
+
+
+def _job_type_settings(attribute, config_key):
+    # Settings declared on the job classes, overridden by a dictionary of
+    # job_type to value in the app config
+    result = {}
+
+    for job_type, mapper in AsyncJob.__mapper__.polymorphic_map.items():
+        result[job_type] = getattr(mapper.class_, attribute, None)
+
+    result.update(current_app.config.get(config_key) or {})
+
+    return {k: v for k, v in result.items() if v is not None}
+
+
+def _claim_order(priorities):
+    result = [AsyncJob.scheduled, AsyncJob.id]
+    priorities = {k: v for k, v in priorities.items() if v}
+
+    if priorities:
+        result.insert(0, case(priorities, value=AsyncJob.job_type, else_=0).desc())
+
+    return result
+
+
+def _delay_for_coalescing(job, windows):
+    window = windows.get(job.job_type)
+
+    if window and job.scheduled:
+        job.scheduled = job.scheduled + window
+        return True
+
+    return False
+
+
+def _job_key(job):
+    return (job.job_type, job.entity_id, job.entity_id_string)
+
+
+def _job_values(job):
+    result = {}
+
+    for c in AsyncJob.__table__.columns:
+        if c.primary_key:
+            continue
+
+        value = getattr(job, c.key, None)
+
+        if value is None and c.default is not None and c.default.is_scalar:
+            value = c.default.arg
+
+        result[c.key] = value
+
+    return result
+
+
+def _insert_ignoring_duplicates(table):
+    dialect = db.engine.dialect.name
+
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    elif dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    elif dialect in ['mysql', 'mariadb']:
+        return mysql.insert(table).prefix_with('IGNORE')
+    else:
+        return insert(table)
+
+
+def _new_claim_id():
+    return f'{socket.gethostname()[:50]}:{os.getpid()}:{uuid.uuid4().hex}'
+
+
 class AsyncJobs:
+    DEFAULT_CLAIM_SIZE = 100
+    DEFAULT_BATCH_SIZE = 1000
+    DEFAULT_SCHEDULE_CHUNK_SIZE = 500
+    DEFAULT_RETENTION_BATCH_SIZE = 500
+    DEFAULT_LEASE = timedelta(minutes=30)
+
+    # Thread pools suit jobs that wait on I/O.  Process pools suit CPU bound
+    # jobs, but can not be used from a daemonic process such as a celery
+    # prefork pool worker.
+    EXECUTOR_SERIAL = 'serial'
+    EXECUTOR_THREAD = 'thread'
+    EXECUTOR_PROCESS = 'process'
+
     @staticmethod
     def due_count():
-        return db.session.execute(select(func.count(AsyncJob.id)).where(AsyncJob.scheduled < datetime.now(timezone.utc))).scalar()
+        return db.session.execute(select(func.count(AsyncJob.id)).where(*_due_criteria(datetime.now(timezone.utc)))).scalar()
 
     @staticmethod
-    def due():
-        return db.session.execute(select(AsyncJob).where(AsyncJob.scheduled < datetime.now(timezone.utc))).scalars()
+    def due(batch_size=None):
+        for batch in AsyncJobs.due_batches(batch_size=batch_size):
+            yield from batch
 
     @staticmethod
-    def run_due():
-        for j in AsyncJobs.due():
-            logging.info(f'Running job: {j}')
-            j.run()
+    def due_batches(batch_size=None, expunge=False):
+        # Pages through the due jobs in (scheduled, id) order, starting each
+        # page after the last row of the one before rather than at an offset,
+        # so every page is a range scan of the scheduled index.  With expunge,
+        # each page is removed from the session once the next is requested,
+        # so that the identity map does not hold every due job at once.
+        now = datetime.now(timezone.utc)
+        batch_size = batch_size or AsyncJobs.DEFAULT_BATCH_SIZE
+        last = None
+
+        while True:
+            q = (
+                select(AsyncJob)
+                .where(*_due_criteria(now))
+                .order_by(AsyncJob.scheduled, AsyncJob.id)
+                .limit(batch_size)
+            )
+
+            if last is not None:
+                q = q.where(or_(
+                    AsyncJob.scheduled > last[0],
+                    and_(AsyncJob.scheduled == last[0], AsyncJob.id > last[1]),
+                ))
+
+            batch = db.session.execute(q).scalars().all()
+
+            if not batch:
+                return
+
+            last = (batch[-1].scheduled, batch[-1].id)
+
+            yield batch
+
+            if expunge:
+                for j in batch:
+                    db.session.expunge(j)
+
+            if len(batch) < batch_size:
+                return
+
+    @staticmethod
+    def claim(limit=None, lease=None, exclude_ids=None):
+        # Marks a batch of due jobs as owned by this worker until the lease
+        # expires, so that other workers do not run them at the same time.
+        #
+        # Higher priority job types are claimed first, and job types with a
+        # concurrency limit are only claimed while fewer than the limit are
+        # claimed by unexpired leases.
+        now = datetime.now(timezone.utc)
+        claim_id = _new_claim_id()
+        lease_expires = now + (lease or AsyncJobs.DEFAULT_LEASE)
+        limit = limit or AsyncJobs.DEFAULT_CLAIM_SIZE
+
+        priorities = AsyncJobs.priorities()
+        max_concurrent = AsyncJobs.max_concurrent()
+
+        if max_concurrent:
+            # The claim's transaction must start once the locks are held
+            db.session.commit()
+
+        with _job_type_locks(max_concurrent.keys()):
+            candidates = select(AsyncJob.id, AsyncJob.job_type, AsyncJob.scheduled).where(*_due_criteria(now))
+
+            if exclude_ids:
+                candidates = candidates.where(AsyncJob.id.not_in(exclude_ids))
+
+            queries = [candidates.where(AsyncJob.job_type.not_in(max_concurrent.keys())).limit(limit)]
+
+            if max_concurrent:
+                running = AsyncJobs.running_counts(now)
+
+                for job_type, maximum in max_concurrent.items():
+                    available = maximum - running.get(job_type, 0)
+
+                    if available > 0:
+                        queries.append(candidates.where(AsyncJob.job_type == job_type).limit(min(limit, available)))
+
+            rows = []
+
+            for q in queries:
+                q = q.order_by(*_claim_order(priorities))
+
+                if db.engine.dialect.name in ['mysql', 'mariadb', 'postgresql']:
+                    # Rows locked by another worker's claim are skipped rather than waited for
+                    rows.extend(db.session.execute(q.with_for_update(skip_locked=True)).all())
+                else:
+                    # SQLite has no row locks, but only one writer at a time, so the
+                    # due criteria are checked again by the update as a compare and set.
+                    rows.extend(db.session.execute(q).all())
+
+            rows.sort(key=lambda r: (-priorities.get(r.job_type, 0), r.scheduled, r.id))
+            ids = [r.id for r in rows[:limit]]
+
+            if ids:
+                db.session.execute(
+                    update(AsyncJob)
+                    .where(AsyncJob.id.in_(ids))
+                    .where(*_due_criteria(now))
+                    .values(claimed_by=claim_id, lease_expires=lease_expires)
+                    .execution_options(synchronize_session=False)
+                )
+
+                _release_over_max_concurrent(claim_id, max_concurrent, {r.job_type for r in rows[:limit]}, now)
+
+            db.session.commit()
+
+        return db.session.execute(
+            select(AsyncJob)
+            .where(AsyncJob.claimed_by == claim_id)
+            .order_by(*_claim_order(priorities))
+        ).scalars().all()
+
+    @staticmethod
+    def heartbeat_lease():
+        return timedelta(seconds=(current_app.config.get('ASYNC_JOBS_HEARTBEAT_SECONDS') or 60) * 3)
+
+    @staticmethod
+    def abandoned():
+        # Jobs claimed by a worker that has stopped renewing its lease
+        return db.session.execute(
+            select(AsyncJob)
+            .where(AsyncJob.claimed_by != None)
+            .where(AsyncJob.lease_expires < datetime.now(timezone.utc))
+        ).scalars().all()
+
+    @staticmethod
+    def reap():
+        # Releases abandoned jobs so that they are run again, counting the
+        # lost run as a failed attempt.  The lease is checked again by the
+        # update in case the job has just been claimed by another worker.
+        now = datetime.now(timezone.utc)
+        abandoned = AsyncJobs.abandoned()
+
+        if not abandoned:
+            return 0
+
+        for j in abandoned:
+            logging.warning(f'Re-queueing abandoned job: {j}')
+
+        out_of_attempts = and_(AsyncJob.max_attempts != None, AsyncJob.attempts + 1 >= AsyncJob.max_attempts)
+
+        result = db.session.execute(
+            update(AsyncJob)
+            .where(AsyncJob.id.in_([j.id for j in abandoned]))
+            .where(AsyncJob.claimed_by != None)
+            .where(AsyncJob.lease_expires < now)
+            .values(
+                error=literal('Abandoned by ') + AsyncJob.claimed_by,
+                attempts=AsyncJob.attempts + 1,
+                dead=case((out_of_attempts, True), else_=False),
+                scheduled=case((out_of_attempts, None), else_=AsyncJob.scheduled),
+                claimed_by=None,
+                lease_expires=None,
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+        db.session.commit()
+
+        return result.rowcount
+
+    @staticmethod
+    def archive_completed(retention=None, archive=None, batch_size=None):
+        # Moves completed jobs older than the retention period to
+        # async_job_archive, or deletes them if archive is False.  Each batch
+        # is its own short transaction, so locks are not held for long.
+        retention = retention or timedelta(days=current_app.config.get('ASYNC_JOBS_RETENTION_DAYS') or 90)
+        archive = current_app.config.get('ASYNC_JOBS_ARCHIVE', True) if archive is None else archive
+        batch_size = batch_size or current_app.config.get('ASYNC_JOBS_RETENTION_BATCH_SIZE') or AsyncJobs.DEFAULT_RETENTION_BATCH_SIZE
+
+        now = datetime.now(timezone.utc)
+        criteria = _completed_before_criteria(now - retention)
+        columns = ['job_type', 'entity_id', 'entity_id_string', 'last_executed']
+        result = 0
+
+        while ids := db.session.execute(
+            select(AsyncJob.id).where(*criteria).order_by(AsyncJob.id).limit(batch_size)
+        ).scalars().all():
+            if archive:
+                db.session.execute(
+                    insert(AsyncJobArchive.__table__).from_select(
+                        ['async_job_id', *columns, 'archived'],
+                        select(AsyncJob.id, *[getattr(AsyncJob, c) for c in columns], literal(now, DateTime))
+                        .where(AsyncJob.id.in_(ids))
+                        .where(*criteria),
+                    )
+                )
+
+            db.session.execute(
+                AsyncJob.__table__.delete()
+                .where(AsyncJob.id.in_(ids))
+                .where(*criteria)
+            )
+            db.session.commit()
+
+            result += len(ids)
+
+        if result:
+            logging.info(f'{"Archived" if archive else "Deleted"} {result} completed jobs')
+
+        return result
+
+    @staticmethod
+    def prune_runs(retention=None, batch_size=None):
+        # Deletes run telemetry older than the retention period in batches
+        retention = retention or timedelta(days=current_app.config.get('ASYNC_JOBS_RETENTION_DAYS') or 90)
+        batch_size = batch_size or current_app.config.get('ASYNC_JOBS_RETENTION_BATCH_SIZE') or AsyncJobs.DEFAULT_RETENTION_BATCH_SIZE
+
+        cutoff = datetime.now(timezone.utc) - retention
+        result = 0
+
+        while ids := db.session.execute(
+            select(AsyncJobRun.id).where(AsyncJobRun.started < cutoff).order_by(AsyncJobRun.id).limit(batch_size)
+        ).scalars().all():
+            db.session.execute(AsyncJobRun.__table__.delete().where(AsyncJobRun.id.in_(ids)))
+            db.session.commit()
+
+            result += len(ids)
+
+        return result
+
+    @staticmethod
+    def due_lag():
+        # Seconds since the longest waiting due job was scheduled
+        now = datetime.now(timezone.utc)
+        oldest = db.session.execute(select(func.min(AsyncJob.scheduled)).where(*_due_criteria(now))).scalar()
+
+        if oldest:
+            return max((now - _as_utc(oldest)).total_seconds(), 0)
+        else:
+            return 0
+
+    @staticmethod
+    def statistics(since=None):
+        # Run counts and durations per job_type, busiest first
+        since = since or datetime.now(timezone.utc) - timedelta(days=1)
+
+        totals = db.session.execute(
+            select(
+                AsyncJobRun.job_type,
+                func.count(AsyncJobRun.id).label('runs'),
+                func.sum(case((AsyncJobRun.succeeded, 1), else_=0)).label('succeeded'),
+                func.sum(AsyncJobRun.duration).label('total_seconds'),
+                func.max(AsyncJobRun.duration).label('max_seconds'),
+                func.count(AsyncJobRun.queue_lag).label('queue_lags'),
+            )
+            .where(AsyncJobRun.started >= since)
+            .group_by(AsyncJobRun.job_type)
+        ).all()
+
+        result = []
+
+        for t in totals:
+            result.append({
+                'job_type': t.job_type,
+                'runs': t.runs,
+                'succeeded': t.succeeded,
+                'failed': t.runs - t.succeeded,
+                'total_seconds': t.total_seconds,
+                'p50_seconds': _run_percentile(since, t.job_type, AsyncJobRun.duration, t.runs, 50),
+                'p95_seconds': _run_percentile(since, t.job_type, AsyncJobRun.duration, t.runs, 95),
+                'max_seconds': t.max_seconds,
+                'p95_queue_lag_seconds': _run_percentile(since, t.job_type, AsyncJobRun.queue_lag, t.queue_lags, 95),
+            })
+
+        return sorted(result, key=lambda r: r['total_seconds'], reverse=True)
+
+    @staticmethod
+    def priorities():
+        return _job_type_settings('priority', 'ASYNC_JOBS_PRIORITIES')
+
+    @staticmethod
+    def max_concurrent():
+        return _job_type_settings('max_concurrent', 'ASYNC_JOBS_MAX_CONCURRENT')
+
+    @staticmethod
+    def coalesce_windows():
+        return {
+            k: v if isinstance(v, timedelta) else timedelta(seconds=v)
+            for k, v in _job_type_settings('coalesce_window', 'ASYNC_JOBS_COALESCE_WINDOWS').items()
+        }
+
+    @staticmethod
+    def running_counts(now=None):
+        now = now or datetime.now(timezone.utc)
+
+        return dict(db.session.execute(
+            select(AsyncJob.job_type, func.count(AsyncJob.id))
+            .where(AsyncJob.claimed_by != None)
+            .where(AsyncJob.lease_expires >= now)
+            .group_by(AsyncJob.job_type)
+        ).all())
+
+    @staticmethod
+    def run_due(limit=None, lease=None, executor=None, max_workers=None, exclude_ids=None, deadline=None):
+        # Jobs are not started once the deadline, a time.monotonic() value,
+        # has passed.  Their claims are released instead.
+        executor = executor or current_app.config.get('ASYNC_JOBS_EXECUTOR') or AsyncJobs.EXECUTOR_SERIAL
+        max_workers = max_workers or current_app.config.get('ASYNC_JOBS_MAX_WORKERS') or 4
+
+        if executor not in (AsyncJobs.EXECUTOR_SERIAL, AsyncJobs.EXECUTOR_THREAD, AsyncJobs.EXECUTOR_PROCESS):
+            raise ValueError(f'Unknown async job executor "{executor}"')
+
+        if executor == AsyncJobs.EXECUTOR_PROCESS:
+            unavailable = _process_pool_unavailable()
+
+            if unavailable:
+                logging.warning(f'The process executor can not be used {unavailable}; using threads instead')
+                executor = AsyncJobs.EXECUTOR_THREAD
+
+        start = time.perf_counter()
+        report = JobBatchReport()
+        lease = lease or AsyncJobs.DEFAULT_LEASE
+        jobs = AsyncJobs.claim(limit=limit, lease=lease, exclude_ids=exclude_ids)
+
+        if not jobs:
+            return report
+
+        claim_id = jobs[0].claimed_by
+        not_run = {j.id for j in jobs}
+
+        try:
+            asyncio_jobs = [j for j in jobs if isinstance(j, AsyncIOJob)]
+
+            if len(asyncio_jobs) > 1 and not _past_deadline(deadline):
+                not_run.difference_update(j.id for j in asyncio_jobs)
+                asyncio_jobs = [j for j in asyncio_jobs if _confirm_claim(j.id, claim_id, lease)]
+                _run_asyncio_jobs(asyncio_jobs, current_app.config.get('ASYNC_JOBS_ASYNCIO_CONCURRENCY') or 20, report)
+                jobs = [j for j in jobs if not isinstance(j, AsyncIOJob)]
+
+            if executor == AsyncJobs.EXECUTOR_SERIAL or len(jobs) < 2:
+                for j in jobs:
+                    if _past_deadline(deadline):
+                        break
+
+                    job_id = j.id
+                    not_run.discard(job_id)
+
+                    if not _confirm_claim(job_id, claim_id, lease):
+                        continue
+
+                    logging.info(f'Running job: {j}')
+                    report.add(j.run(), job_id)
+            else:
+                job_ids = [j.id for j in jobs]
+                run_job = partial(AsyncJobs._pool_function(executor), claim_id, lease, deadline)
+
+                with AsyncJobs._pool(executor, max_workers, len(job_ids)) as pool:
+                    for job_id, succeeded in zip(job_ids, pool.map(run_job, job_ids)):
+                        # Unrun jobs stay in not_run; the release only touches
+                        # those still claimed by this batch.
+                        if succeeded is not None:
+                            not_run.discard(job_id)
+                            report.add(succeeded, job_id)
+        finally:
+            _release_claims(not_run, claim_id)
+
+        report.seconds = time.perf_counter() - start
+
+        if report.total:
+            logging.info(f'Ran job batch: {report} ({report.jobs_per_second:.1f} jobs per second)')
+
+        return report
+
+    @staticmethod
+    def drain(max_seconds=None, max_jobs=None, **kwargs):
+        # Runs batches of due jobs until none are left or a budget is used
+        # up.  Each job is run at most once per drain, so a job that fails
+        # without being rescheduled is not run over and over again.
+        #
+        # Returns the report and whether any work was left undone.
+        start = time.perf_counter()
+        deadline = None if max_seconds is None else time.monotonic() + max_seconds
+        report = JobBatchReport()
+
+        while True:
+            limit = AsyncJobs.DEFAULT_CLAIM_SIZE
+
+            if max_jobs is not None:
+                limit = min(limit, max_jobs - report.total)
+
+            batch = AsyncJobs.run_due(limit=limit, exclude_ids=report.job_ids, deadline=deadline, **kwargs)
+            report.extend(batch)
+            report.seconds = time.perf_counter() - start
+
+            out_of_jobs = max_jobs is not None and report.total >= max_jobs
+            out_of_time = _past_deadline(deadline)
+
+            if not (batch.total or out_of_time):
+                return report, False
+
+            if out_of_jobs or out_of_time:
+                remaining = db.session.execute(
+                    select(func.count(AsyncJob.id))
+                    .where(*_due_criteria(datetime.now(timezone.utc)))
+                    .where(AsyncJob.id.not_in(report.job_ids))
+                ).scalar()
+
+                return report, remaining > 0
+
+    @staticmethod
+    @contextmanager
+    def _pool(executor, max_workers, job_count):
+        if executor == AsyncJobs.EXECUTOR_THREAD:
+            with ThreadPoolExecutor(max_workers=min(max_workers, job_count), thread_name_prefix='async_job') as pool:
+                yield pool
+        else:
+            app = current_app._get_current_object()
+            pool = _process_pool(app, max_workers)
+
+            try:
+                yield pool
+            except BrokenProcessPool:
+                _discard_process_pool(app, pool)
+                raise
+
+    @staticmethod
+    def _pool_function(executor):
+        if executor == AsyncJobs.EXECUTOR_PROCESS:
+            return _run_job_in_process
+        else:
+            return partial(_run_job_in_app_context, current_app._get_current_object())
 
     @staticmethod
     def schedule(job: AsyncJob):
+        coalescing = _delay_for_coalescing(job, AsyncJobs.coalesce_windows())
+
         logging.info(f'Scheduling job: {job}')
 
         existing: AsyncJob = db.session.execute(
@@ -116,11 +1199,19 @@ class AsyncJobs:
         ).scalar_one_or_none()
     
         if existing:
-            existing.scheduled = job.scheduled
+            if coalescing and existing.scheduled and _as_utc(existing.scheduled) < _as_utc(job.scheduled):
+                logging.info(f'Coalescing with the run already scheduled for {existing.scheduled}')
+            else:
+                existing.scheduled = job.scheduled
+
             existing.error = job.error
-            existing.retry = job.retry
+            existing.retry = bool(job.retry)
             existing.retry_timedelta_period = job.retry_timedelta_period
             existing.retry_timedelta_size = job.retry_timedelta_size
+            existing.retry_backoff = bool(job.retry_backoff)
+            existing.max_attempts = job.max_attempts
+            existing.attempts = 0
+            existing.dead = False
 
             if not existing.scheduled_before_rerun():
                 # Do not reschedule if it has resently been run
@@ -129,17 +1220,300 @@ class AsyncJobs:
             db.session.add(job)
 
 
+    @staticmethod
+    def schedule_many(jobs, chunk_size=None):
+        # Schedules jobs as AsyncJobs.schedule does, but with three
+        # statements per chunk rather than a round trip per job.
+        #
+        # The unique key on (job_type, entity_id, entity_id_string) can not
+        # find an existing job when either entity id is NULL, so a single
+        # upsert would duplicate those jobs.  Instead the existing jobs are
+        # looked up in one query, the new ones inserted in one statement
+        # (ignoring any inserted in the meantime) and the existing ones
+        # rescheduled in one update that leaves recently run jobs alone.
+        jobs = list({_job_key(j): j for j in jobs}.values())
+        chunk_size = chunk_size or AsyncJobs.DEFAULT_SCHEDULE_CHUNK_SIZE
+        windows = AsyncJobs.coalesce_windows()
+
+        for j in jobs:
+            _delay_for_coalescing(j, windows)
+
+        logging.info(f'Scheduling {len(jobs)} jobs')
+
+        for start in range(0, len(jobs), chunk_size):
+            AsyncJobs._schedule_chunk(jobs[start:start + chunk_size], windows)
+
+    @staticmethod
+    def _schedule_chunk(jobs, windows):
+        table = AsyncJob.__table__
+        c = table.c
+
+        entity_ids = {j.entity_id for j in jobs if j.entity_id is not None}
+        entity_id_strings = {j.entity_id_string for j in jobs if j.entity_id_string is not None}
+
+        existing = {}
+
+        for row in db.session.execute(
+            select(c.id, c.job_type, c.entity_id, c.entity_id_string)
+            .where(c.job_type.in_({j.job_type for j in jobs}))
+            .where(or_(
+                c.entity_id.in_(entity_ids),
+                c.entity_id_string.in_(entity_id_strings),
+                and_(c.entity_id == None, c.entity_id_string == None),
+            ))
+        ):
+            existing.setdefault((row.job_type, row.entity_id, row.entity_id_string), []).append(row.id)
+
+        new_jobs = [j for j in jobs if _job_key(j) not in existing]
+
+        if new_jobs:
+            db.session.execute(_insert_ignoring_duplicates(table).values([_job_values(j) for j in new_jobs]))
+
+        updates = {id: j for j in jobs for id in existing.get(_job_key(j), [])}
+
+        if updates:
+            def by_id(f):
+                return case({id: f(j) for id, j in updates.items()}, value=c.id)
+
+            cutoff = by_id(lambda j: j.rerun_cutoff())
+            scheduled = by_id(lambda j: j.scheduled)
+            coalescing = [id for id, j in updates.items() if j.job_type in windows and j.scheduled]
+
+            if coalescing:
+                # Keep an earlier run that is already scheduled
+                scheduled = case(
+                    (and_(c.id.in_(coalescing), c.scheduled != None, c.scheduled < scheduled), c.scheduled),
+                    else_=scheduled,
+                )
+
+            db.session.execute(
+                update(table)
+                .where(c.id.in_(updates.keys()))
+                .where(or_(c.last_executed == None, cutoff.is_(None), c.last_executed <= cutoff))
+                .values(
+                    scheduled=scheduled,
+                    error=by_id(lambda j: j.error),
+                    retry=by_id(lambda j: bool(j.retry)),
+                    retry_timedelta_period=by_id(lambda j: j.retry_timedelta_period),
+                    retry_timedelta_size=by_id(lambda j: j.retry_timedelta_size),
+                    retry_backoff=by_id(lambda j: bool(j.retry_backoff)),
+                    max_attempts=by_id(lambda j: j.max_attempts),
+                    attempts=0,
+                    dead=False,
+                )
+            )
+
+
+# Dispatchers start a drain of the due jobs without waiting for it.  The
+# ASYNC_JOBS_DISPATCHER setting chooses 'celery', 'celery_fan_out', 'thread'
+# or any object with a dispatch method.  By default celery is used if a BROKER_URL is set, and
+# otherwise a thread in the current process, which avoids both needing a
+# broker and blocking the request.
+
+class CeleryJobDispatcher:
+    def dispatch(self):
+        _run_jobs.delay()
+        return True
+
+
+class CeleryFanOutJobDispatcher:
+    # Spreads the due jobs across the celery workers, rather than draining
+    # them all in one task
+    def dispatch(self):
+        _fan_out_jobs.delay()
+        return True
+
+
+class ThreadJobDispatcher:
+    # Drains on a small thread pool.  A drain runs every due job, so when
+    # max_queue drains are already waiting another is not added.  Waiting
+    # drains are cancelled on shutdown, but running ones are finished.
+    def __init__(self, app, max_workers=1, max_queue=1):
+        self.app = app
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='async_job_dispatcher')
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._closed = False
+
+        atexit.register(self.shutdown)
+
+    def dispatch(self):
+        with self._lock:
+            if self._closed or self._waiting >= self.max_queue:
+                return False
+
+            self._waiting += 1
+
+        self._executor.submit(self._run)
+        return True
+
+    def _run(self):
+        with self._lock:
+            self._waiting -= 1
+
+        with self.app.app_context():
+            try:
+                _drain()
+            except Exception as e:
+                log_exception(e)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._closed = True
+
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+_DISPATCHER_EXTENSION = 'lbrc_flask.async_job_dispatcher'
+_dispatcher_lock = threading.Lock()
+
+
+def job_dispatcher():
+    app = current_app._get_current_object()
+
+    with _dispatcher_lock:
+        if _DISPATCHER_EXTENSION not in app.extensions:
+            app.extensions[_DISPATCHER_EXTENSION] = _create_dispatcher(app)
+
+        return app.extensions[_DISPATCHER_EXTENSION]
+
+
+def _create_dispatcher(app):
+    dispatcher = app.config.get('ASYNC_JOBS_DISPATCHER')
+
+    if dispatcher and not isinstance(dispatcher, str):
+        return dispatcher
+
+    if not dispatcher:
+        dispatcher = 'celery' if app.config.get('BROKER_URL') else 'thread'
+
+    if dispatcher == 'celery':
+        return CeleryJobDispatcher()
+    elif dispatcher == 'celery_fan_out':
+        return CeleryFanOutJobDispatcher()
+    elif dispatcher == 'thread':
+        return ThreadJobDispatcher(
+            app,
+            max_workers=app.config.get('ASYNC_JOBS_THREAD_WORKERS') or 1,
+            max_queue=app.config.get('ASYNC_JOBS_THREAD_QUEUE') or 1,
+        )
+    else:
+        raise ValueError(f'Unknown async job dispatcher "{dispatcher}"')
+
+
 def run_jobs_asynch():
-    _run_jobs.delay()
+    return job_dispatcher().dispatch()
 
 
 @celery.task()
 def _run_jobs():
+    _drain()
+
+
+def _drain():
     logging.debug('started')
 
-    while AsyncJobs.due_count():
-        AsyncJobs.run_due()
+    AsyncJobs.reap()
+
+    report, work_left = AsyncJobs.drain(
+        max_seconds=current_app.config.get('ASYNC_JOBS_DRAIN_MAX_SECONDS'),
+        max_jobs=current_app.config.get('ASYNC_JOBS_DRAIN_MAX_JOBS'),
+    )
 
-    # AsyncJobs.run_due()
+    logging.info(f'Drained jobs: {report}')
+
+    # Hand the worker back and queue another drain for the rest, unless
+    # this drain ran nothing at all, when another would get no further.
+    if work_left and report.total:
+        logging.info('Budget used up with jobs still due; re-enqueueing')
+        run_jobs_asynch()
 
     logging.debug('Ended')
+
+
+@celery.task()
+def _fan_out_jobs():
+    # Claims the due jobs and sends their ids to the workers in chunks.  If
+    # there is a result backend, a callback totals the chunks' reports and
+    # fans out again if jobs are still due.
+    AsyncJobs.reap()
+
+    jobs = AsyncJobs.claim(limit=current_app.config.get('ASYNC_JOBS_FAN_OUT_MAX_JOBS') or 1000)
+
+    if not jobs:
+        return
+
+    claimed_by = jobs[0].claimed_by
+    job_ids = [j.id for j in jobs]
+    chunk_size = current_app.config.get('ASYNC_JOBS_FAN_OUT_CHUNK_SIZE') or 50
+
+    chunks = group(
+        _run_job_chunk.s(claimed_by, job_ids[i:i + chunk_size])
+        for i in range(0, len(job_ids), chunk_size)
+    )
+
+    logging.info(f'Fanning out {len(job_ids)} jobs in {len(chunks.tasks)} chunks')
+
+    if celery.conf.result_backend:
+        chord(chunks)(_report_job_chunks.s())
+    else:
+        chunks.apply_async()
+
+
+@celery.task()
+def _run_job_chunk(claimed_by, job_ids):
+    start = time.perf_counter()
+    report = JobBatchReport()
+
+    for job_id in job_ids:
+        # The claim may have been reaped while the chunk was queued
+        if not _confirm_claim(job_id, claimed_by, AsyncJobs.DEFAULT_LEASE):
+            continue
+
+        job = db.session.get(AsyncJob, job_id)
+        logging.info(f'Running job: {job}')
+        report.add(job.run(), job_id)
+
+    report.seconds = time.perf_counter() - start
+
+    logging.info(f'Ran job chunk: {report}')
+
+    return report.as_dict()
+
+
+@celery.task()
+def _report_job_chunks(reports):
+    result = {
+        'chunks': len(reports),
+        'succeeded': sum(r['succeeded'] for r in reports),
+        'failed': sum(r['failed'] for r in reports),
+        'seconds': sum(r['seconds'] for r in reports),
+    }
+
+    logging.info(f'Ran fanned out jobs: {result}')
+
+    if result['succeeded'] and AsyncJobs.due_count():
+        run_jobs_asynch()
+
+    return result
+
+
+@celery.task()
+def _archive_jobs():
+    # A retention period of 0 days keeps jobs for ever
+    if not current_app.config.get('ASYNC_JOBS_RETENTION_DAYS', 90):
+        return
+
+    AsyncJobs.archive_completed()
+    AsyncJobs.prune_runs()
+
+
+@celery.on_after_configure.connect
+def _schedule_archive_jobs(sender, **kwargs):
+    # Opted into with ASYNC_JOBS_ARCHIVE_INTERVAL_MINUTES, and only run if
+    # the application runs celery beat
+    minutes = sender.conf.get('async_jobs_archive_interval_minutes')
+
+    if minutes:
+        sender.add_periodic_task(timedelta(minutes=minutes), _archive_jobs.s(), name='Archive completed async jobs')
@@ -0,0 +1,340 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import functools
+import hashlib
+import logging
+import threading
+import time
+import traceback
+from flask import current_app, has_app_context
+from .backends import CacheBackend, MemoryCacheBackend, SqliteCacheBackend, RemoteCacheBackend, PickleCodec
+from .statistics import CacheStatistics, register_cache_statistics, get_cache_statistics, cache_statistics
+from .tags import cache_tag, invalidate_cache_tags, _index as _tag_index
+from .request import request_cached, clear_request_cache
+
+# This is called with the values for lru_cache and timedelta.  For example:
+# @timed_cache(maxsize=10, typed=True, days=3)
+#
+# lru_cache parameters: maxsize, typed
+# timedelta parameters: days - or seconds, microseconds, milliseconds, minutes, hours, weeks
+#
+# Each entry expires on its own once it is older than the timedelta, rather
+# than the whole cache being flushed at once.  When the cache is full the
+# least recently used entry is evicted.
+#
+# Pass maxbytes to also limit the cache by the approximate memory used by the
+# values, measured as the size of the pickled value or by calling sizer(value)
+# if given.  Least recently used entries are evicted until the cache is back
+# under budget and values larger than maxbytes are not cached at all.
+#
+# Pass single_flight=True to make sure that only one thread recomputes an
+# expired or missing key at a time.  Other callers for the same key are given
+# the stale value if there is one, otherwise they wait for the result.
+#
+# Pass stale_while_revalidate=timedelta(...) to keep serving an expired value
+# for that long after it expires while it is recomputed in the background.
+# Only one refresh per key runs at a time, on a small shared thread pool
+# unless refresh_executor is given.
+#
+# By default each process keeps its own cache in memory.  Pass a backend to
+# share a cache between processes, e.g., gunicorn and celery workers:
+#
+# @timed_cache(hours=1, backend=SqliteCacheBackend('/tmp/app_cache.db'))
+#
+# Entries in a shared backend are keyed by the function's module and name
+# (or namespace, if given) and the repr of the arguments, so arguments
+# should have a repr that is the same in every process.
+#
+# Hits, misses, expirations, evictions, size and compute times for every
+# cached function are available from cache_statistics(), or from the
+# decorated function's cache_info().
+#
+# Pass tags to invalidate entries when the models they depend on are
+# committed (see tags.py).  Either a list of tags for the whole cache:
+#
+# @timed_cache(days=1, tags=[FieldType])
+#
+# or a function that is given the same arguments and returns the tags for
+# each entry:
+#
+# @timed_cache(days=1, tags=lambda role_id: [(Role, role_id)])
+#
+# Only the committing process hears about the commit, so tags need a shared
+# backend, which also keeps the tags of each entry.  An in memory cache may
+# be tagged by also passing local_invalidation=True, where it is only used
+# by a single process.
+
+
+class _Flight:
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._exception = None
+
+    def set_result(self, value):
+        self._value = value
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+
+        if self._exception is not None:
+            raise self._exception
+
+        return self._value
+
+
+def _stable_key(args, kwargs, typed):
+    parts = [repr(a) for a in args]
+    parts.extend(f'{k}={v!r}' for k, v in sorted(kwargs.items()))
+
+    if typed:
+        parts.extend(type(a).__qualname__ for a in args)
+        parts.extend(type(v).__qualname__ for _, v in sorted(kwargs.items()))
+
+    return hashlib.sha1('\x1f'.join(parts).encode('utf8')).hexdigest()
+
+
+_refresh_executor = None
+_refresh_executor_lock = threading.Lock()
+
+
+def _default_refresh_executor():
+    global _refresh_executor
+
+    with _refresh_executor_lock:
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='timed_cache_refresh')
+
+        return _refresh_executor
+
+
+def timed_cache(**timedelta_kwargs):
+
+    def _wrapper(f):
+        maxsize = timedelta_kwargs.pop('maxsize', 128)
+        typed = timedelta_kwargs.pop('typed', False)
+        maxbytes = timedelta_kwargs.pop('maxbytes', None)
+        sizer = timedelta_kwargs.pop('sizer', None)
+        single_flight = timedelta_kwargs.pop('single_flight', False)
+        stale_while_revalidate = timedelta_kwargs.pop('stale_while_revalidate', None) or timedelta()
+        refresh_executor = timedelta_kwargs.pop('refresh_executor', None)
+        backend = timedelta_kwargs.pop('backend', None) or MemoryCacheBackend()
+        namespace = timedelta_kwargs.pop('namespace', None) or f'{f.__module__}.{f.__qualname__}'
+        tags = timedelta_kwargs.pop('tags', None)
+        local_invalidation = timedelta_kwargs.pop('local_invalidation', False)
+        ttl = timedelta(**timedelta_kwargs).total_seconds()
+        grace = stale_while_revalidate.total_seconds()
+
+        if tags is not None and not backend.shared and not local_invalidation:
+            raise ValueError(
+                f'Cache {namespace} is tagged but its backend is not shared, so other processes '
+                'would not see invalidations.  Use a shared backend, or pass local_invalidation=True.'
+            )
+
+        cache = backend.bind(namespace=namespace, maxsize=maxsize, retention=grace, maxbytes=maxbytes, sizer=sizer)
+        make_key = _stable_key if backend.shared else functools._make_key
+        flights = {}
+        lock = threading.Lock()
+        statistics = register_cache_statistics(CacheStatistics(namespace, store=cache))
+        generation = 0
+
+        # The lock only guards flights and generation.  Stores look after
+        # their own thread safety, so that a slow shared backend does not
+        # hold up callers for other keys.
+
+        def _invalidate(key):
+            nonlocal generation
+
+            with lock:
+                # Values being calculated when the invalidation happens are not stored
+                generation += 1
+
+            if key is None:
+                cache.clear()
+            else:
+                cache.delete(key)
+
+        # Entry tags are kept by the store, so that any process can delete
+        # the entries with a tag.  The most recent invalidations are kept
+        # here so that values calculated while their tags were invalidated
+        # are not stored.
+        tag_invalidations = deque(maxlen=256)
+        tag_sequence = 0
+
+        def _invalidate_tagged(changed_tags):
+            nonlocal tag_sequence
+
+            with lock:
+                tag_sequence += 1
+                tag_invalidations.append((tag_sequence, frozenset(changed_tags)))
+
+            cache.delete_tagged(changed_tags)
+
+        def _tags_invalidated_since(sequence, entry_tags):
+            with lock:
+                # Too many invalidations to tell
+                if tag_sequence - sequence > len(tag_invalidations):
+                    return True
+
+                return any(s > sequence and not changed.isdisjoint(entry_tags) for s, changed in tag_invalidations)
+
+        if callable(tags):
+            _tag_index.add_entry_invalidator(_invalidate_tagged)
+        elif tags is not None:
+            for t in tags:
+                _tag_index.add_model_tag(cache_tag(t), _invalidate)
+
+        def _started():
+            return generation, tag_sequence
+
+        def _invalidated_since(started, entry_tags):
+            started_generation, started_sequence = started
+            return started_generation != generation or (entry_tags and _tags_invalidated_since(started_sequence, entry_tags))
+
+        def _store(key, value, started, args, kwargs):
+            entry_tags = {cache_tag(t) for t in tags(*args, **kwargs)} if callable(tags) else set()
+
+            if _invalidated_since(started, entry_tags):
+                return
+
+            cache.set(key, value, expires=time.time() + ttl, tags=entry_tags)
+
+            # Invalidated while it was being stored
+            if _invalidated_since(started, entry_tags):
+                cache.delete(key)
+
+        def _call(args, kwargs):
+            start = time.perf_counter()
+            value = f(*args, **kwargs)
+            statistics.computed(time.perf_counter() - start)
+
+            return value
+
+        def _compute(key, args, kwargs):
+            started = _started()
+            value = _call(args, kwargs)
+            _store(key, value, started, args, kwargs)
+
+            return value
+
+        def _compute_single_flight(key, flight, args, kwargs):
+            started = _started()
+
+            try:
+                value = _call(args, kwargs)
+            except BaseException as e:
+                with lock:
+                    flights.pop(key, None)
+
+                flight.set_exception(e)
+                raise
+
+            _store(key, value, started, args, kwargs)
+
+            with lock:
+                flights.pop(key, None)
+
+            flight.set_result(value)
+            return value
+
+        def _lead_flight(key, flight, args, kwargs):
+            # The cache is read outside the lock, so the previous leader may
+            # have stored the value since
+            entry = cache.get(key)
+
+            if entry is not None and time.time() < entry[1]:
+                with lock:
+                    flights.pop(key, None)
+
+                flight.set_result(entry[0])
+                return entry[0]
+
+            return _compute_single_flight(key, flight, args, kwargs)
+
+        def _refresh(app, key, flight, args, kwargs):
+            try:
+                if app is None:
+                    _compute_single_flight(key, flight, args, kwargs)
+                else:
+                    with app.app_context():
+                        _compute_single_flight(key, flight, args, kwargs)
+            except Exception:
+                logging.error(f'Error refreshing cached value for {f.__qualname__}')
+                logging.error(traceback.format_exc())
+
+        def _start_refresh(key, flight, args, kwargs):
+            app = current_app._get_current_object() if has_app_context() else None
+            executor = refresh_executor or _default_refresh_executor()
+            executor.submit(_refresh, app, key, flight, args, kwargs)
+
+        @functools.wraps(f)
+        def _wrapped(*args, **kwargs):
+            key = make_key(args, kwargs, typed)
+            entry = cache.get(key)
+            now = time.time()
+
+            with lock:
+                if entry is not None and now < entry[1]:
+                    statistics.hit()
+                    return entry[0]
+
+                in_grace = entry is not None and now < entry[1] + grace
+                flight = flights.get(key)
+
+                if flight is not None and (in_grace or single_flight):
+                    if entry is not None:
+                        # Someone else is already recomputing, so serve the stale value
+                        statistics.hit(stale=True)
+                        return entry[0]
+
+                    leader = False
+                elif in_grace or single_flight:
+                    flight = flights[key] = _Flight()
+                    leader = True
+                else:
+                    flight = None
+
+                if in_grace:
+                    statistics.hit(stale=True)
+                else:
+                    statistics.miss(expired=entry is not None)
+
+            if flight is None:
+                return _compute(key, args, kwargs)
+            elif not leader:
+                return flight.wait()
+            elif in_grace:
+                _start_refresh(key, flight, args, kwargs)
+                return entry[0]
+            else:
+                return _lead_flight(key, flight, args, kwargs)
+
+        def cache_clear():
+            cache.clear()
+
+        _wrapped.cache_clear = cache_clear
+        _wrapped.cache_info = statistics.as_dict
+        _wrapped.cache_statistics = statistics
+
+        return _wrapped
+    return _wrapper
+
+
+def init_caching(app):
+    from lbrc_flask.security import must_be_admin
+    from flask_login import login_required
+
+    app.teardown_request(clear_request_cache)
+    app.teardown_appcontext(clear_request_cache)
+
+    @app.route('/lbrc_flask/cache_statistics')
+    @login_required
+    @must_be_admin()
+    def lbrc_flask_cache_statistics():
+        return {'caches': cache_statistics()}
@@ -0,0 +1,484 @@
+import math
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+# A backend is bound once for each cached function.  The bound store
+# holds entries as (value, expires) where expires is a unix timestamp,
+# so that entries written by one process are understood by another.
+# Retention is the number of seconds after an entry expires that it
+# may still be served as a stale value.  Maxbytes limits the approximate
+# memory used by the values, as measured by sizer.
+#
+# Stores must implement:
+#   get(key) -> (value, expires) or None
+#   set(key, value, expires, tags=())
+#   delete(key)
+#   delete_tagged(tags) - deletes the entries set with any of the tags
+#   clear()
+#   size() -> number of entries, or None if the backend cannot tell
+#   size_bytes() -> approximate size of the values, or None if not measured
+#
+# Stores that evict entries themselves count them in an evictions attribute.
+# Stores are called from many threads at once, without any outside lock.
+
+
+class PickleCodec:
+    def dumps(self, value):
+        return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+def pickled_size(value):
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+def _tag_name(tag):
+    # Tags are strings or (model name, primary key) tuples, whose repr is
+    # the same in every process
+    return repr(tag)
+
+
+class CacheBackend:
+    # Shared backends are seen by other processes, so they need keys
+    # that are stable between processes rather than Python hashes.
+    shared = False
+
+    def bind(self, namespace, maxsize, retention, maxbytes=None, sizer=None):
+        raise NotImplementedError()
+
+
+class MemoryCacheBackend(CacheBackend):
+    def bind(self, namespace, maxsize, retention, maxbytes=None, sizer=None):
+        return _MemoryStore(maxsize, maxbytes, sizer)
+
+
+class _MemoryStore:
+    def __init__(self, maxsize, maxbytes=None, sizer=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizer = sizer or pickled_size
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._key_tags = {}
+        self._tag_keys = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+            return entry
+
+    def set(self, key, value, expires, tags=()):
+        if self.maxsize == 0:
+            return
+
+        # Values are sized before taking the lock, as sizing may be slow
+        size = self.sizer(value) if self.maxbytes is not None else None
+
+        with self._lock:
+            self._delete(key)
+
+            if size is not None:
+                if size > self.maxbytes:
+                    return
+
+                self._sizes[key] = size
+                self.bytes += size
+
+            self._entries[key] = (value, expires)
+
+            if tags:
+                self._key_tags[key] = tags
+
+                for t in tags:
+                    self._tag_keys.setdefault(t, set()).add(key)
+
+            while self._over_budget():
+                self._delete(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _over_budget(self):
+        if self.maxsize is not None and len(self._entries) > self.maxsize:
+            return True
+
+        return self.maxbytes is not None and self.bytes > self.maxbytes
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def _delete(self, key):
+        self._entries.pop(key, None)
+        self.bytes -= self._sizes.pop(key, 0)
+
+        for t in self._key_tags.pop(key, ()):
+            keys = self._tag_keys[t]
+            keys.discard(key)
+
+            if not keys:
+                del self._tag_keys[t]
+
+    def delete_tagged(self, tags):
+        with self._lock:
+            for key in set().union(*(self._tag_keys.get(t, ()) for t in tags)):
+                self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._key_tags.clear()
+            self._tag_keys.clear()
+            self.bytes = 0
+
+    def size(self):
+        return len(self._entries)
+
+    def size_bytes(self):
+        if self.maxbytes is not None:
+            return self.bytes
+
+
+class SqliteCacheBackend(CacheBackend):
+    shared = True
+
+    # Hits only record when an entry was last used if that is more than
+    # touch_interval seconds out of date, so that most reads do not write.
+    # Least recently used eviction is accurate to about that long.
+    def __init__(self, path, codec=None, mmap_size=64 * 1024 * 1024, touch_interval=5):
+        self.path = str(path)
+        self.codec = codec or PickleCodec()
+        self.mmap_size = mmap_size
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+
+        # Backends are usually created at import, before any worker
+        # processes are forked, so this connection is not kept.
+        conn = self._connect()
+
+        try:
+            with conn:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS cache_entry (
+                        namespace TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        value BLOB NOT NULL,
+                        expires REAL NOT NULL,
+                        accessed REAL NOT NULL,
+                        PRIMARY KEY (namespace, key)
+                    )
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx__cache_entry__accessed ON cache_entry (namespace, accessed)')
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS cache_tag (
+                        namespace TEXT NOT NULL,
+                        tag TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        PRIMARY KEY (namespace, tag, key)
+                    )
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx__cache_tag__key ON cache_tag (namespace, key)')
+
+                # Entries are removed by expiry, eviction, delete and clear
+                conn.execute('''
+                    CREATE TRIGGER IF NOT EXISTS trg__cache_entry__delete_tags
+                    AFTER DELETE ON cache_entry
+                    BEGIN
+                        DELETE FROM cache_tag WHERE namespace = OLD.namespace AND key = OLD.key;
+                    END
+                ''')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+
+        return conn
+
+    def connection(self):
+        # sqlite connections can not be shared between threads, or with a
+        # forked child process.  A connection inherited over a fork is
+        # abandoned rather than closed, as closing it may disturb the
+        # parent's use of the database.
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+
+        return conn
+
+    def bind(self, namespace, maxsize, retention, maxbytes=None, sizer=None):
+        # The size of a value is the size of its serialised form
+        return _SqliteStore(self, namespace, maxsize, retention, maxbytes)
+
+
+class _SqliteStore:
+    def __init__(self, backend, namespace, maxsize, retention, maxbytes=None):
+        self.backend = backend
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.retention = retention
+        self.maxbytes = maxbytes
+        self.evictions = 0
+
+    def get(self, key):
+        with self.backend.connection() as conn:
+            row = conn.execute(
+                'SELECT value, expires, accessed FROM cache_entry WHERE namespace = ? AND key = ?',
+                (self.namespace, key),
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            now = time.time()
+
+            if now - row[2] > self.backend.touch_interval:
+                conn.execute(
+                    'UPDATE cache_entry SET accessed = ? WHERE namespace = ? AND key = ?',
+                    (now, self.namespace, key),
+                )
+
+        return self.backend.codec.loads(row[0]), row[1]
+
+    def set(self, key, value, expires, tags=()):
+        if self.maxsize == 0:
+            return
+
+        now = time.time()
+        data = self.backend.codec.dumps(value)
+
+        if self.maxbytes is not None and len(data) > self.maxbytes:
+            self.delete(key)
+            return
+
+        with self.backend.connection() as conn:
+            # Replacing a row does not fire the delete trigger
+            conn.execute('DELETE FROM cache_tag WHERE namespace = ? AND key = ?', (self.namespace, key))
+            conn.execute(
+                'INSERT OR REPLACE INTO cache_entry (namespace, key, value, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+                (self.namespace, key, data, expires, now),
+            )
+            conn.executemany(
+                'INSERT OR IGNORE INTO cache_tag (namespace, tag, key) VALUES (?, ?, ?)',
+                [(self.namespace, _tag_name(t), key) for t in tags],
+            )
+
+            # Entries that can no longer be served, even as stale values, are removed
+            conn.execute(
+                'DELETE FROM cache_entry WHERE namespace = ? AND expires < ?',
+                (self.namespace, now - self.retention),
+            )
+
+            if self.maxsize is not None:
+                evicted = conn.execute('''
+                    DELETE FROM cache_entry
+                    WHERE namespace = ?
+                        AND key IN (
+                            SELECT key
+                            FROM cache_entry
+                            WHERE namespace = ?
+                            ORDER BY accessed DESC
+                            LIMIT -1 OFFSET ?
+                        )
+                ''', (self.namespace, self.namespace, self.maxsize))
+
+                self.evictions += max(evicted.rowcount, 0)
+
+            if self.maxbytes is not None:
+                self._evict_to_maxbytes(conn)
+
+    def _evict_to_maxbytes(self, conn):
+        total = self._size_bytes(conn)
+
+        if total <= self.maxbytes:
+            return
+
+        evict = []
+
+        for key, length in conn.execute(
+            'SELECT key, LENGTH(value) FROM cache_entry WHERE namespace = ? ORDER BY accessed',
+            (self.namespace,),
+        ):
+            if total <= self.maxbytes:
+                break
+
+            evict.append((self.namespace, key))
+            total -= length
+
+        conn.executemany('DELETE FROM cache_entry WHERE namespace = ? AND key = ?', evict)
+        self.evictions += len(evict)
+
+    def _size_bytes(self, conn):
+        return conn.execute(
+            'SELECT COALESCE(SUM(LENGTH(value)), 0) FROM cache_entry WHERE namespace = ?',
+            (self.namespace,),
+        ).fetchone()[0]
+
+    def delete(self, key):
+        with self.backend.connection() as conn:
+            conn.execute('DELETE FROM cache_entry WHERE namespace = ? AND key = ?', (self.namespace, key))
+
+    def delete_tagged(self, tags):
+        tag_names = [_tag_name(t) for t in tags]
+
+        with self.backend.connection() as conn:
+            conn.execute(f'''
+                DELETE FROM cache_entry
+                WHERE namespace = ?
+                    AND key IN (
+                        SELECT key
+                        FROM cache_tag
+                        WHERE namespace = ?
+                            AND tag IN ({', '.join('?' * len(tag_names))})
+                    )
+            ''', (self.namespace, self.namespace, *tag_names))
+
+    def clear(self):
+        with self.backend.connection() as conn:
+            conn.execute('DELETE FROM cache_entry WHERE namespace = ?', (self.namespace,))
+
+    def size(self):
+        with self.backend.connection() as conn:
+            return conn.execute('SELECT COUNT(*) FROM cache_entry WHERE namespace = ?', (self.namespace,)).fetchone()[0]
+
+    def size_bytes(self):
+        with self.backend.connection() as conn:
+            return self._size_bytes(conn)
+
+
+class RemoteCacheBackend(CacheBackend):
+    # For memcached or redis style clients that provide get, set and delete.
+    # The keyword used by the client's set method to give the expiry time
+    # in seconds is given by expire_argument: 'expire' for pymemcache,
+    # 'ex' for redis-py.  The server is responsible for limiting the size
+    # of the cache, so maxsize and maxbytes are not used.
+    shared = True
+
+    #
+    # Each store remembers its namespace's version for version_ttl seconds,
+    # so a clear from another process is seen within that time.
+    def __init__(self, client, codec=None, prefix='lbrc_flask', expire_argument='expire', version_ttl=1):
+        self.client = client
+        self.codec = codec or PickleCodec()
+        self.prefix = prefix
+        self.expire_argument = expire_argument
+        self.version_ttl = version_ttl
+
+    def bind(self, namespace, maxsize, retention, maxbytes=None, sizer=None):
+        return _RemoteStore(self, namespace, retention)
+
+
+class _RemoteStore:
+    def __init__(self, backend, namespace, retention):
+        self.backend = backend
+        self.namespace = namespace
+        self.retention = retention
+        self._checked_version = None
+
+    def _version_key(self):
+        return f'{self.backend.prefix}:{self.namespace}:version'
+
+    def _version(self):
+        # Remote caches can not list their keys, so clearing works by
+        # moving every key in the namespace onto a new version.
+        checked = self._checked_version
+
+        if checked is None or time.monotonic() - checked[1] >= self.backend.version_ttl:
+            checked = self._checked_version = (self._fetch_version(), time.monotonic())
+
+        return checked[0]
+
+    def _fetch_version(self):
+        return int(self.backend.client.get(self._version_key()) or 0)
+
+    def _key(self, key):
+        return f'{self.backend.prefix}:{self.namespace}:{self._version()}:{key}'
+
+    # Each tag has a version key, shared by every namespace, that is given
+    # a new random value when the tag is invalidated.  Entries keep the
+    # versions of their tags from when they were set and are missed if any
+    # has changed.  A version is always set before it is used, so that a
+    # version key evicted by the server also misses.
+
+    def _tag_key(self, tag_name):
+        return f'{self.backend.prefix}:tag:{tag_name}'
+
+    def _tag_version(self, tag_name):
+        version = self.backend.client.get(self._tag_key(tag_name))
+
+        if isinstance(version, bytes):
+            version = version.decode('utf8')
+
+        return version
+
+    def _new_tag_version(self, tag_name):
+        version = uuid.uuid4().hex
+        self.backend.client.set(self._tag_key(tag_name), version)
+
+        return version
+
+    def get(self, key):
+        data = self.backend.client.get(self._key(key))
+
+        if data is None:
+            return None
+
+        value, expires, *tag_versions = self.backend.codec.loads(data)
+
+        for tag_name, version in (tag_versions[0] if tag_versions else {}).items():
+            if self._tag_version(tag_name) != version:
+                return None
+
+        return value, expires
+
+    def set(self, key, value, expires, tags=()):
+        seconds = max(1, math.ceil(expires - time.time() + self.retention))
+        tag_versions = {}
+
+        for tag_name in map(_tag_name, tags):
+            tag_versions[tag_name] = self._tag_version(tag_name) or self._new_tag_version(tag_name)
+
+        self.backend.client.set(
+            self._key(key),
+            self.backend.codec.dumps((value, expires, tag_versions)),
+            **{self.backend.expire_argument: seconds},
+        )
+
+    def delete(self, key):
+        self.backend.client.delete(self._key(key))
+
+    def delete_tagged(self, tags):
+        for tag_name in map(_tag_name, tags):
+            self._new_tag_version(tag_name)
+
+    def clear(self):
+        version = self._fetch_version() + 1
+        self.backend.client.set(self._version_key(), str(version))
+        self._checked_version = (version, time.monotonic())
+
+    def size(self):
+        return None
@@ -0,0 +1,97 @@
+import hashlib
+import time
+from flask import current_app
+from flask_login import current_user
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from .backends import MemoryCacheBackend
+from .statistics import CacheStatistics, register_cache_statistics
+
+# Caches the rendered output of part of a template:
+#
+# {% cache 'main_menu', 600 %}
+#     ...
+# {% endcache %}
+#
+# The key may be any expression and the time to live is in seconds.  The
+# roles of the current user are always added to the key, so anything that
+# depends on the user themselves must also be included in the key.
+
+FRAGMENT_CACHE_NAME = 'lbrc_flask.fragment_cache'
+DEFAULT_FRAGMENT_TTL = 300
+
+
+def _user_roles():
+    if getattr(current_app, 'login_manager', None) is None or not current_user.is_authenticated:
+        return ()
+
+    return tuple(sorted(r.name for r in current_user.roles))
+
+
+def configure_fragment_cache(environment, backend=None, maxsize=1024):
+    store = (backend or MemoryCacheBackend()).bind(namespace=FRAGMENT_CACHE_NAME, maxsize=maxsize, retention=0)
+
+    environment.fragment_cache_store = store
+    environment.fragment_cache_statistics = register_cache_statistics(
+        CacheStatistics(FRAGMENT_CACHE_NAME, store=store),
+    )
+
+
+def init_fragment_cache(app):
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
+    configure_fragment_cache(
+        app.jinja_env,
+        backend=app.config.get('LBRC_FLASK_FRAGMENT_CACHE_BACKEND'),
+        maxsize=app.config.get('LBRC_FLASK_FRAGMENT_CACHE_MAXSIZE', 1024),
+    )
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+
+        configure_fragment_cache(environment)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        key = parser.parse_expression()
+
+        if parser.stream.skip_if('comma'):
+            ttl = parser.parse_expression()
+        else:
+            ttl = nodes.Const(None)
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(
+            self.call_method('_render', [key, ttl]), [], [], body,
+        ).set_lineno(lineno)
+
+    def _render(self, key, ttl, caller):
+        store = self.environment.fragment_cache_store
+        statistics = self.environment.fragment_cache_statistics
+        full_key = hashlib.sha1(repr((key, _user_roles())).encode('utf8')).hexdigest()
+
+        entry = store.get(full_key)
+
+        if entry is not None and time.time() < entry[1]:
+            statistics.hit()
+            return Markup(entry[0])
+
+        statistics.miss(expired=entry is not None)
+
+        start = time.perf_counter()
+        value = str(caller())
+        statistics.computed(time.perf_counter() - start)
+
+        if ttl is None:
+            ttl = DEFAULT_FRAGMENT_TTL
+
+        store.set(full_key, value, expires=time.time() + ttl)
+
+        return Markup(value)
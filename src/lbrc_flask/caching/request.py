@@ -0,0 +1,60 @@
+import functools
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Results are kept in flask.g for the rest of the current request or app
+# context, and are cleared when it is torn down.  Outside of an app context,
+# e.g., in a celery task that does not push one, the function is just called.
+#
+# Results are also forgotten whenever a database session is flushed,
+# committed or rolled back, so that a lookup made before a change is not
+# returned after it.
+
+_G_ATTRIBUTE = '_lbrc_flask_request_cache'
+_MISSING = object()
+
+
+def request_cached():
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not has_app_context():
+                return f(*args, **kwargs)
+
+            try:
+                key = (f, functools._make_key(args, kwargs, False))
+                hash(key)
+            except TypeError:
+                return f(*args, **kwargs)
+
+            cache = g.setdefault(_G_ATTRIBUTE, {})
+            result = cache.get(key, _MISSING)
+
+            if result is _MISSING:
+                result = cache[key] = f(*args, **kwargs)
+
+            return result
+
+        return decorated_function
+    return decorator
+
+
+def clear_request_cache(*args):
+    if has_app_context():
+        g.pop(_G_ATTRIBUTE, None)
+
+
+@event.listens_for(Session, 'after_flush')
+def _clear_after_flush(session, flush_context):
+    clear_request_cache()
+
+
+@event.listens_for(Session, 'after_commit')
+def _clear_after_commit(session):
+    clear_request_cache()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _clear_after_rollback(session):
+    clear_request_cache()
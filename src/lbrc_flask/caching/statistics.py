@@ -0,0 +1,111 @@
+import threading
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class CacheStatistics:
+    def __init__(self, name, store=None):
+        self.name = name
+        self.store = store
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.stale_hits = 0
+            self.misses = 0
+            self.expirations = 0
+            self.computations = 0
+            self.compute_seconds = 0.0
+
+            if getattr(self.store, 'evictions', None) is not None:
+                self.store.evictions = 0
+
+    def hit(self, stale=False):
+        with self._lock:
+            self.hits += 1
+
+            if stale:
+                self.stale_hits += 1
+
+    def miss(self, expired=False):
+        with self._lock:
+            self.misses += 1
+
+            if expired:
+                self.expirations += 1
+
+    def computed(self, seconds):
+        with self._lock:
+            self.computations += 1
+            self.compute_seconds += seconds
+
+    @property
+    def evictions(self):
+        return getattr(self.store, 'evictions', None)
+
+    @property
+    def size(self):
+        if self.store is None:
+            return None
+
+        return self.store.size()
+
+    @property
+    def size_bytes(self):
+        if self.store is None or not hasattr(self.store, 'size_bytes'):
+            return None
+
+        return self.store.size_bytes()
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+
+        if total:
+            return self.hits / total
+
+    @property
+    def average_compute_seconds(self):
+        if self.computations:
+            return self.compute_seconds / self.computations
+
+    def as_dict(self):
+        with self._lock:
+            result = {
+                'name': self.name,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'expirations': self.expirations,
+                'computations': self.computations,
+                'hit_ratio': self.hit_ratio,
+                'average_compute_seconds': self.average_compute_seconds,
+            }
+
+        result['evictions'] = self.evictions
+        result['size'] = self.size
+        result['size_bytes'] = self.size_bytes
+
+        return result
+
+
+def register_cache_statistics(statistics):
+    with _registry_lock:
+        _registry[statistics.name] = statistics
+
+    return statistics
+
+
+def get_cache_statistics(name):
+    return _registry.get(name)
+
+
+def cache_statistics():
+    with _registry_lock:
+        statistics = sorted(_registry.values(), key=lambda s: s.name)
+
+    return [s.as_dict() for s in statistics]
@@ -0,0 +1,123 @@
+import threading
+from itertools import chain
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+# Cache entries can be tagged with the models they depend on.  A tag may be
+# given as:
+#   a model class, e.g., FieldType, invalidated by any change to that model
+#   a model instance, or a (model class, primary key) tuple, invalidated by
+#       changes to that row
+#   a string
+#
+# Changes are collected when a session is flushed and the tagged entries are
+# invalidated once the session is committed.  Rolled back changes are ignored.
+#
+# Invalidation happens in the committing process, which must have imported
+# the cached function.  Entries held in a shared backend, which also keeps
+# the tags of each entry, are removed for every process.  Entries held in
+# memory by other processes would only expire when their time runs out, so
+# timed_cache only accepts tags for an in memory cache when given
+# local_invalidation=True.
+
+_SESSION_INFO_KEY = 'lbrc_flask_cache_tags'
+
+
+def cache_tag(value):
+    if isinstance(value, str):
+        return value
+    elif isinstance(value, type):
+        return value.__name__
+    elif isinstance(value, tuple):
+        model, key = value
+        return (cache_tag(model), key)
+    else:
+        return (type(value).__name__, _primary_key(value))
+
+
+def _primary_key(instance):
+    state = inspect(instance)
+    key = state.mapper.primary_key_from_instance(instance)
+
+    if len(key) == 1:
+        return key[0]
+    else:
+        return tuple(key)
+
+
+def _tags_for_instance(instance):
+    key = _primary_key(instance)
+
+    for cls in type(instance).__mro__:
+        if '__mapper__' in vars(cls):
+            yield cls.__name__
+            yield (cls.__name__, key)
+
+
+class _TagIndex:
+    # Caches tagged as a whole are cleared when one of their tags is
+    # invalidated.  Caches that tag each entry are told of every
+    # invalidation, and their stores delete the entries with those tags,
+    # whichever process cached them.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._model_tags = {}
+        self._entry_invalidators = set()
+
+    def add_model_tag(self, tag, invalidator):
+        with self._lock:
+            self._model_tags.setdefault(tag, set()).add(invalidator)
+
+    def add_entry_invalidator(self, invalidator):
+        with self._lock:
+            self._entry_invalidators.add(invalidator)
+
+    def invalidate(self, tags):
+        clear = set()
+
+        with self._lock:
+            for t in tags:
+                clear.update(self._model_tags.get(t, ()))
+
+            entry_invalidators = list(self._entry_invalidators)
+
+        for invalidator in clear:
+            invalidator(None)
+
+        if tags:
+            for invalidator in entry_invalidators:
+                invalidator(tags)
+
+    def __bool__(self):
+        return bool(self._model_tags or self._entry_invalidators)
+
+
+_index = _TagIndex()
+
+
+def invalidate_cache_tags(*tags):
+    _index.invalidate({cache_tag(t) for t in tags})
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_tags(session, flush_context):
+    if not _index:
+        return
+
+    tags = session.info.setdefault(_SESSION_INFO_KEY, set())
+
+    for instance in chain(session.new, session.dirty, session.deleted):
+        tags.update(_tags_for_instance(instance))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_tags(session):
+    tags = session.info.pop(_SESSION_INFO_KEY, None)
+
+    if tags:
+        _index.invalidate(tags)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back_tags(session):
+    session.info.pop(_SESSION_INFO_KEY, None)
@@ -1,8 +1,11 @@
 import logging
+import os
+import threading
 from pathlib import Path
 from celery import Celery
 from celery.signals import after_setup_logger
 from flask import current_app
+from flask.globals import _cv_app
 
 
 celery = Celery()
@@ -14,22 +17,83 @@ class Config():
         self.task_default_rate_limit = app.config["CELERY_RATE_LIMIT"]
         self.worker_redirect_stdouts_level = app.config["CELERY_REDIRECT_STDOUTS_LEVEL"]
         self.task_default_queue = app.config["CELERY_DEFAULT_QUEUE"]
+        self.async_jobs_archive_interval_minutes = app.config.get("ASYNC_JOBS_ARCHIVE_INTERVAL_MINUTES", 0)
 
 
 
+# With CELERY_REUSE_APP_CONTEXT, each worker process (or thread, for the
+# threads pool) pushes one app context for its first task and keeps it for
+# the rest.  Between tasks the context is reset as if it had been popped:
+# the teardown functions are called, which removes the scoped session, and
+# g is replaced.
+
+_worker = threading.local()
+
+
+def _worker_app_context(app):
+    ctx = getattr(_worker, 'app_context', None)
+
+    if ctx is not None and ctx.app is app and _worker.pid == os.getpid() and _cv_app.get(None) is ctx:
+        return ctx
+
+    # Another app context is in use, e.g., a task called directly from a
+    # request, so it must not be replaced
+    if _cv_app.get(None) is not None:
+        return None
+
+    ctx = app.app_context()
+    ctx.push()
+
+    _worker.app_context = ctx
+    _worker.pid = os.getpid()
+
+    return ctx
+
+
+def _reset_app_context(ctx, exc=None):
+    ctx.app.do_teardown_appcontext(exc)
+    ctx.g = ctx.app.app_ctx_globals_class()
+
+
 def init_celery(app, title):
     global celery
 
     celery.config_from_object(Config(app))
+    celery.Task = _context_task(celery.Task, app)
+
 
-    class ContextTask(celery.Task):
+def _context_task(base, app):
+    reuse_app_context = app.config.get('CELERY_REUSE_APP_CONTEXT', False)
+
+    class ContextTask(base):
         rate_limit = app.config['CELERY_RATE_LIMIT']
         
         def __call__(self, *args, **kwargs):
-            with app.app_context():
-                return self.run(*args, **kwargs)
+            # A task called from within another task, directly or eagerly,
+            # gets a context of its own, so that its reset does not tear
+            # down the outer task's context part way through.
+            outermost = not getattr(_worker, 'in_task', False)
+            ctx = _worker_app_context(app) if reuse_app_context and outermost else None
+
+            if ctx is None:
+                with app.app_context():
+                    return self.run(*args, **kwargs)
+
+            _worker.in_task = True
+
+            try:
+                result = self.run(*args, **kwargs)
+            except BaseException as e:
+                _reset_app_context(ctx, e)
+                raise
+            finally:
+                _worker.in_task = False
+
+            _reset_app_context(ctx)
+
+            return result
 
-    celery.Task = ContextTask
+    return ContextTask
 
 
 @after_setup_logger.connect
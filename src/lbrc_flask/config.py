@@ -45,6 +45,10 @@ class BaseConfig:
     LBRC_UOL_LDAP_SECURITY = os.getenv("LBRC_UOL_LDAP_SECURITY", 'True') == 'True'
     LBRC_UHL_LDAP_SECURITY = os.getenv("LBRC_UHL_LDAP_SECURITY", 'True') == 'True'
 
+    # Caching
+    LBRC_FLASK_FRAGMENT_CACHE_BACKEND = None
+    LBRC_FLASK_FRAGMENT_CACHE_MAXSIZE = int(os.getenv("LBRC_FLASK_FRAGMENT_CACHE_MAXSIZE", "1024"))
+
     # Users
     ADMIN_EMAIL_ADDRESS = os.getenv("ADMIN_EMAIL_ADDRESS", '')
     ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", '')
@@ -77,6 +81,29 @@ class BaseConfig:
     CELERY_REDIRECT_STDOUTS_LEVEL = os.getenv("CELERY_REDIRECT_STDOUTS_LEVEL", '')
     CELERY_DEFAULT_QUEUE = os.getenv("CELERY_DEFAULT_QUEUE", '')
     CELERY_LOG_DIRECTORY = os.getenv("CELERY_LOG_DIRECTORY", ".")
+    CELERY_REUSE_APP_CONTEXT = os.getenv("CELERY_REUSE_APP_CONTEXT", "False") == 'True'
+
+    # Async Jobs
+    ASYNC_JOBS_EXECUTOR = os.getenv("ASYNC_JOBS_EXECUTOR", "serial")
+    ASYNC_JOBS_MAX_WORKERS = int(os.getenv("ASYNC_JOBS_MAX_WORKERS", "4"))
+    ASYNC_JOBS_DRAIN_MAX_SECONDS = int(os.getenv("ASYNC_JOBS_DRAIN_MAX_SECONDS", "300"))
+    ASYNC_JOBS_DRAIN_MAX_JOBS = int(os.getenv("ASYNC_JOBS_DRAIN_MAX_JOBS", "1000"))
+    ASYNC_JOBS_PRIORITIES = {}
+    ASYNC_JOBS_MAX_CONCURRENT = {}
+    ASYNC_JOBS_COALESCE_WINDOWS = {}
+    ASYNC_JOBS_TELEMETRY = os.getenv("ASYNC_JOBS_TELEMETRY", "True") == 'True'
+    ASYNC_JOBS_HEARTBEAT_SECONDS = int(os.getenv("ASYNC_JOBS_HEARTBEAT_SECONDS", "60"))
+    ASYNC_JOBS_RETENTION_DAYS = int(os.getenv("ASYNC_JOBS_RETENTION_DAYS", "90"))
+    ASYNC_JOBS_ARCHIVE = os.getenv("ASYNC_JOBS_ARCHIVE", "True") == 'True'
+    ASYNC_JOBS_RETENTION_BATCH_SIZE = int(os.getenv("ASYNC_JOBS_RETENTION_BATCH_SIZE", "500"))
+    # Archive completed jobs from celery beat every so many minutes; 0 is off
+    ASYNC_JOBS_ARCHIVE_INTERVAL_MINUTES = int(os.getenv("ASYNC_JOBS_ARCHIVE_INTERVAL_MINUTES", "0"))
+    ASYNC_JOBS_DISPATCHER = os.getenv("ASYNC_JOBS_DISPATCHER", '')
+    ASYNC_JOBS_THREAD_WORKERS = int(os.getenv("ASYNC_JOBS_THREAD_WORKERS", "1"))
+    ASYNC_JOBS_THREAD_QUEUE = int(os.getenv("ASYNC_JOBS_THREAD_QUEUE", "1"))
+    ASYNC_JOBS_FAN_OUT_CHUNK_SIZE = int(os.getenv("ASYNC_JOBS_FAN_OUT_CHUNK_SIZE", "50"))
+    ASYNC_JOBS_FAN_OUT_MAX_JOBS = int(os.getenv("ASYNC_JOBS_FAN_OUT_MAX_JOBS", "1000"))
+    ASYNC_JOBS_ASYNCIO_CONCURRENCY = int(os.getenv("ASYNC_JOBS_ASYNCIO_CONCURRENCY", "20"))
 
 
 
@@ -1,8 +1,15 @@
 import urllib
 from flask import request
+from lbrc_flask.caching import request_cached
 
 
 def all_args():
+    # Callers may change the dictionary, so give them their own copy
+    return dict(_all_args())
+
+
+@request_cached()
+def _all_args():
     result = {**request.view_args, **request.args, **request.form}
 
     if request.data and request.json:
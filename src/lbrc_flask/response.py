@@ -1,4 +1,10 @@
-from flask import Response
+import hashlib
+from datetime import timezone
+from functools import wraps
+from flask import Response, current_app, make_response, request
+from flask_login import current_user
+from sqlalchemy import select, func
+from lbrc_flask.database import db
 
 REFRESH_RESULTS_TRIGGER = 'refresh_results'
 REFRESH_DETAILS_TRIGGER = 'refreshDetails'
@@ -26,3 +32,103 @@ def trigger_response(trigger_name):
     resp = Response('')
     resp.headers['HX-Trigger'] = trigger_name
     return resp
+
+
+def audit_validator(model, *criteria):
+    # The latest change and the number of rows, so that deletions also
+    # change the validator.  Intended for models that use AuditMixin.
+    return tuple(db.session.execute(
+        select(func.max(model.last_update_date), func.count())
+        .select_from(model)
+        .where(*criteria)
+    ).one())
+
+
+def _current_user_id():
+    if getattr(current_app, 'login_manager', None) is None:
+        return None
+
+    return current_user.get_id()
+
+
+def _set_caching_headers(resp, etag, last_modified, max_age):
+    if etag is not None:
+        resp.set_etag(etag, weak=True)
+
+    if last_modified is not None:
+        resp.last_modified = last_modified
+
+    resp.cache_control.private = True
+    resp.cache_control.max_age = max_age
+
+    if max_age == 0:
+        resp.cache_control.no_cache = True
+
+    resp.vary.update(['Cookie', 'HX-Request'])
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return etag is not None and request.if_none_match.contains_weak(etag)
+
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+
+    return False
+
+
+# Decorator for views that returns 304 Not Modified when the page has not
+# changed since the client last requested it.
+#
+# etag and last_modified are functions that are given the view's arguments.
+# The value returned by etag can be anything with a stable repr, for example
+# audit_validator(Model).  If neither is given the ETag is a hash of the
+# rendered response, which saves bandwidth but not rendering.
+#
+# @conditional_get(etag=lambda id: audit_validator(Study, Study.id == id))
+def conditional_get(etag=None, last_modified=None, max_age=0):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method not in ['GET', 'HEAD'] or (etag is None and last_modified is None):
+                resp = make_response(f(*args, **kwargs))
+
+                if request.method in ['GET', 'HEAD'] and resp.status_code == 200:
+                    _set_caching_headers(resp, None, None, max_age)
+                    resp.add_etag()
+                    resp.make_conditional(request)
+
+                return resp
+
+            validator = None
+            modified = None
+
+            if etag is not None:
+                key = repr((
+                    _current_user_id(),
+                    request.full_path,
+                    request.headers.get('HX-Request'),
+                    etag(*args, **kwargs),
+                ))
+                validator = hashlib.sha1(key.encode('utf8')).hexdigest()
+
+            if last_modified is not None:
+                modified = last_modified(*args, **kwargs)
+
+                if modified is not None and modified.tzinfo is None:
+                    modified = modified.replace(tzinfo=timezone.utc)
+
+            if _not_modified(validator, modified):
+                resp = Response(status=304)
+                _set_caching_headers(resp, validator, modified, max_age)
+                return resp
+
+            resp = make_response(f(*args, **kwargs))
+
+            if resp.status_code == 200:
+                _set_caching_headers(resp, validator, modified, max_age)
+
+            return resp
+
+        return decorated_function
+    return decorator
@@ -4,6 +4,7 @@ from flask_login import current_user
 from flask import current_app, abort, render_template
 from flask_security.utils import _datastore
 from functools import wraps
+from ..caching import request_cached
 from ..database import db
 from .model import User, Role, AuditMixin, random_password
 
@@ -18,6 +19,7 @@ def system_user_id():
 SYSTEM_USER_NAME = 'system'
 
 
+@request_cached()
 def get_system_user():
     return _datastore.find_user(username=SYSTEM_USER_NAME)
 
@@ -26,6 +28,7 @@ def get_role_from_name(name):
     return _datastore.find_or_create_role(name=name)
 
 
+@request_cached()
 def get_admin_role():
     return get_role_from_name(name=Role.ADMIN_ROLENAME)
 
@@ -5,9 +5,12 @@ from flask import g, request, current_app
 from markdown import markdown
 from .formatters import format_currency, format_date, format_datetime, format_month, format_number, format_yesno, humanize_datetime, humanize_date
 from markupsafe import Markup
+from .caching.fragments import init_fragment_cache
 
 
 def init_template_filters(app):
+    init_fragment_cache(app)
+
     @app.template_filter("yes_no")
     def yesno_format(value):
         return format_yesno(value)
@@ -1,4 +1,4 @@
-from lbrc_flask.admin import AdminCustomView, init_admin
+from lbrc_flask.admin import AdminCustomView, AsyncJobStatisticsView, init_admin
 from lbrc_flask.pytest.helpers import login
 from lbrc_flask.database import db
 from lbrc_flask.security import User, Role
@@ -22,10 +22,29 @@ def test__admin__is_not_admin__is_not_accessible(client, faker):
     assert not out.is_accessible()
 
 
+def test__admin__async_job_statistics__is_admin__is_accessible(client, faker):
+    user = faker.get_test_user(is_admin=True)
+    login(client, faker, user)
+
+    out = AsyncJobStatisticsView(name='Jobs')
+
+    assert out.is_accessible()
+
+
+def test__admin__async_job_statistics__is_not_admin__is_not_accessible(client, faker):
+    user = faker.get_test_user()
+    login(client, faker, user)
+
+    out = AsyncJobStatisticsView(name='Jobs')
+
+    assert not out.is_accessible()
+
+
 def test__admin__init_admin__loads_views(app):
     views = [
         AdminCustomView(User, db.session),
         AdminCustomView(Role, db.session),
+        AsyncJobStatisticsView(name='Jobs'),
     ]
 
     with app.app_context():
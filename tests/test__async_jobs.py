@@ -0,0 +1,1479 @@
+import asyncio
+import threading
+import time
+import pytest
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+from flask import Flask, current_app
+from lbrc_flask.celery import celery
+from lbrc_flask.database import db
+from lbrc_flask.async_jobs import (
+    AsyncJob, AsyncIOJob, AsyncJobArchive, AsyncJobRun, AsyncJobs, ThreadJobDispatcher,
+    CeleryFanOutJobDispatcher, job_dispatcher, run_jobs_asynch, _run_jobs, _archive_jobs,
+    _fan_out_jobs, _run_job_chunk, _report_job_chunks, _extend_lease,
+    _schedule_archive_jobs,
+)
+
+
+class RecordingJob(AsyncJob):
+    __mapper_args__ = {
+        "polymorphic_identity": "test_recording",
+    }
+
+    runs = []
+
+    def _run_actual(self):
+        RecordingJob.runs.append((self.entity_id, threading.current_thread().name))
+
+
+class FailingJob(AsyncJob):
+    __mapper_args__ = {
+        "polymorphic_identity": "test_failing",
+    }
+
+    def _run_actual(self):
+        raise ValueError('Broken')
+
+
+class UrgentJob(AsyncJob):
+    __mapper_args__ = {
+        "polymorphic_identity": "test_urgent",
+    }
+
+    priority = 10
+
+    def _run_actual(self):
+        pass
+
+
+class LimitedJob(AsyncJob):
+    __mapper_args__ = {
+        "polymorphic_identity": "test_limited",
+    }
+
+    max_concurrent = 2
+
+    def _run_actual(self):
+        pass
+
+
+class SlowJob(AsyncJob):
+    __mapper_args__ = {
+        "polymorphic_identity": "test_slow",
+    }
+
+    leases = []
+
+    def _run_actual(self):
+        time.sleep(0.35)
+
+        with db.engine.connect() as conn:
+            SlowJob.leases.append(conn.execute(
+                db.select(AsyncJob.lease_expires).where(AsyncJob.id == self.id)
+            ).scalar())
+
+
+class SlowAsyncJob(AsyncIOJob):
+    __mapper_args__ = {
+        "polymorphic_identity": "test_slow_async",
+    }
+
+    leases = []
+
+    async def _run_actual(self):
+        await asyncio.sleep(0.35)
+
+        with db.engine.connect() as conn:
+            SlowAsyncJob.leases.append(conn.execute(
+                db.select(AsyncJob.lease_expires).where(AsyncJob.id == self.id)
+            ).scalar())
+
+
+class SleepingJob(AsyncIOJob):
+    __mapper_args__ = {
+        "polymorphic_identity": "test_sleeping",
+    }
+
+    running = 0
+    max_running = 0
+    saved = []
+
+    async def _run_actual(self):
+        SleepingJob.running += 1
+        SleepingJob.max_running = max(SleepingJob.max_running, SleepingJob.running)
+
+        await asyncio.sleep(0.2)
+
+        SleepingJob.running -= 1
+
+        if self.entity_id_string == 'fail':
+            raise ValueError('Broken')
+
+        return self.entity_id * 10
+
+    def _save(self, result):
+        if self.entity_id_string == 'fail_save':
+            raise ValueError('Not saved')
+
+        SleepingJob.saved.append(result)
+
+
+class CoalescedJob(AsyncJob):
+    __mapper_args__ = {
+        "polymorphic_identity": "test_coalesced",
+    }
+
+    coalesce_window = timedelta(minutes=5)
+
+    def _run_actual(self):
+        pass
+
+
+class StolenJob(AsyncJob):
+    __mapper_args__ = {
+        "polymorphic_identity": "test_stolen",
+    }
+
+    runs = []
+    stolen = False
+
+    def _run_actual(self):
+        StolenJob.runs.append(self.entity_id)
+
+        if StolenJob.stolen:
+            return
+
+        StolenJob.stolen = True
+        app = current_app._get_current_object()
+
+        # Another worker reaps the batch's claims while this job runs
+        def other_worker():
+            with app.app_context():
+                db.session.execute(db.update(AsyncJob).values(lease_expires=past()))
+                db.session.commit()
+                AsyncJobs.reap()
+                AsyncJobs.run_due()
+                db.session.remove()
+
+        thread = threading.Thread(target=other_worker)
+        thread.start()
+        thread.join()
+
+
+class InterruptedJob(AsyncJob):
+    __mapper_args__ = {
+        "polymorphic_identity": "test_interrupted",
+    }
+
+    def _run_actual(self):
+        raise KeyboardInterrupt()
+
+
+@pytest.fixture(scope="function")
+def job_app(tmp_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "jobs.db"}'
+    db.init_app(app)
+
+    RecordingJob.runs = []
+    StolenJob.runs = []
+    StolenJob.stolen = False
+    SleepingJob.max_running = 0
+    SleepingJob.saved = []
+
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+def past(**kwargs):
+    return datetime.now(timezone.utc) - timedelta(**(kwargs or {'minutes': 1}))
+
+
+def add_jobs(count, job_class=RecordingJob, **kwargs):
+    scheduled = kwargs.pop('scheduled', None) or past()
+    jobs = [job_class(entity_id=i, scheduled=scheduled, **kwargs) for i in range(count)]
+    db.session.add_all(jobs)
+    db.session.commit()
+
+    return jobs
+
+
+def test__claim__claims_due_jobs(job_app):
+    add_jobs(3)
+    db.session.add(RecordingJob(entity_id=99, scheduled=datetime.now(timezone.utc) + timedelta(hours=1)))
+    db.session.commit()
+
+    actual = AsyncJobs.claim()
+
+    assert sorted(j.entity_id for j in actual) == [0, 1, 2]
+    assert all(j.claimed_by for j in actual)
+    assert all(j.lease_expires for j in actual)
+    assert AsyncJobs.due_count() == 0
+
+
+def test__claim__limit(job_app):
+    add_jobs(5)
+
+    assert len(AsyncJobs.claim(limit=2)) == 2
+    assert AsyncJobs.due_count() == 3
+
+
+def test__claim__already_claimed__not_claimed_again(job_app):
+    add_jobs(3)
+
+    first = AsyncJobs.claim()
+    second = AsyncJobs.claim()
+
+    assert len(first) == 3
+    assert second == []
+
+
+def test__claim__lease_expired__claimed_again(job_app):
+    add_jobs(3)
+
+    AsyncJobs.claim(lease=timedelta(seconds=-1))
+
+    assert len(AsyncJobs.claim()) == 3
+
+
+def test__claim__concurrent_workers__no_job_claimed_twice(job_app):
+    add_jobs(200)
+
+    def worker(_):
+        with job_app.app_context():
+            claimed = []
+
+            while batch := AsyncJobs.claim(limit=7):
+                claimed.extend(j.id for j in batch)
+
+            db.session.remove()
+            return claimed
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(worker, range(4)))
+
+    all_claimed = [id for r in results for id in r]
+
+    assert len(all_claimed) == 200
+    assert len(set(all_claimed)) == 200
+
+
+def test__run_due__runs_and_releases_jobs(job_app):
+    add_jobs(3)
+
+    AsyncJobs.run_due()
+
+    assert sorted(id for id, _ in RecordingJob.runs) == [0, 1, 2]
+
+    for j in db.session.execute(db.select(AsyncJob)).scalars():
+        assert j.claimed_by is None
+        assert j.lease_expires is None
+        assert j.scheduled is None
+
+
+def test__run_due__failed__claim_released(job_app):
+    add_jobs(1, job_class=FailingJob, retry=True, retry_timedelta_period=AsyncJob.TIMEDELTA_HOURS, retry_timedelta_size=1)
+
+    AsyncJobs.run_due()
+
+    j = db.session.execute(db.select(AsyncJob)).scalar_one()
+    assert j.error == 'Broken'
+    assert j.claimed_by is None
+    assert j.scheduled is not None
+
+
+def test__run_due__serial__report(job_app):
+    add_jobs(3)
+    add_jobs(2, job_class=FailingJob)
+
+    actual = AsyncJobs.run_due(executor=AsyncJobs.EXECUTOR_SERIAL)
+
+    assert actual.total == 5
+    assert actual.succeeded == 3
+    assert actual.failed == 2
+    assert actual.jobs_per_second > 0
+
+
+def test__run_due__thread_executor(job_app):
+    add_jobs(20)
+    add_jobs(2, job_class=FailingJob)
+
+    actual = AsyncJobs.run_due(executor=AsyncJobs.EXECUTOR_THREAD, max_workers=4)
+
+    assert actual.succeeded == 20
+    assert actual.failed == 2
+    assert sorted(id for id, _ in RecordingJob.runs) == list(range(20))
+    assert all(name.startswith('async_job') for _, name in RecordingJob.runs)
+    assert db.session.execute(db.select(db.func.count(AsyncJob.id)).where(AsyncJob.claimed_by != None)).scalar() == 0
+
+
+def test__run_due__process_executor(job_app):
+    add_jobs(6)
+
+    actual = AsyncJobs.run_due(executor=AsyncJobs.EXECUTOR_PROCESS, max_workers=2)
+
+    assert actual.succeeded == 6
+    assert db.session.execute(db.select(db.func.count(AsyncJob.id)).where(AsyncJob.scheduled != None)).scalar() == 0
+
+
+def test__run_due__process_executor__pool_reused(job_app):
+    add_jobs(4)
+    AsyncJobs.run_due(executor=AsyncJobs.EXECUTOR_PROCESS, max_workers=2)
+    pool = job_app.extensions['lbrc_flask.async_job_process_pool'][2]
+
+    add_jobs(4, job_class=UrgentJob)
+    actual = AsyncJobs.run_due(executor=AsyncJobs.EXECUTOR_PROCESS, max_workers=2)
+
+    assert actual.succeeded == 4
+    assert job_app.extensions['lbrc_flask.async_job_process_pool'][2] is pool
+
+
+def test__run_due__process_executor__not_main_thread__uses_threads(job_app):
+    add_jobs(3)
+    result = {}
+
+    def run():
+        with job_app.app_context():
+            result['report'] = AsyncJobs.run_due(executor=AsyncJobs.EXECUTOR_PROCESS, max_workers=2)
+            db.session.remove()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+
+    assert result['report'].succeeded == 3
+    assert all(name.startswith('async_job') for _, name in RecordingJob.runs)
+    assert 'lbrc_flask.async_job_process_pool' not in job_app.extensions
+
+
+def test__run_due__process_executor__daemonic_process__uses_threads(job_app):
+    add_jobs(3)
+
+    with patch('lbrc_flask.async_jobs.multiprocessing.current_process', return_value=MagicMock(daemon=True)):
+        actual = AsyncJobs.run_due(executor=AsyncJobs.EXECUTOR_PROCESS, max_workers=2)
+
+    assert actual.succeeded == 3
+    assert all(name.startswith('async_job') for _, name in RecordingJob.runs)
+    assert 'lbrc_flask.async_job_process_pool' not in job_app.extensions
+
+
+def test__run_due__executor_from_config(job_app):
+    job_app.config['ASYNC_JOBS_EXECUTOR'] = AsyncJobs.EXECUTOR_THREAD
+    add_jobs(3)
+
+    AsyncJobs.run_due()
+
+    assert all(name.startswith('async_job') for _, name in RecordingJob.runs)
+
+
+def test__run_due__unknown_executor(job_app):
+    add_jobs(2)
+
+    with pytest.raises(ValueError):
+        AsyncJobs.run_due(executor='carrier_pigeon')
+
+    assert AsyncJobs.due_count() == 2
+
+
+def test__run_due__claim_lost__job_not_run(job_app):
+    add_jobs(2, job_class=StolenJob)
+
+    AsyncJobs.run_due(lease=timedelta(seconds=1))
+
+    assert sorted(StolenJob.runs) == [0, 0, 1]
+
+
+@pytest.mark.parametrize("executor", [AsyncJobs.EXECUTOR_SERIAL, AsyncJobs.EXECUTOR_THREAD])
+def test__run_due__claim_lost__not_reported(job_app, executor):
+    add_jobs(3)
+    jobs = AsyncJobs.claim()
+    db.session.execute(db.update(AsyncJob).where(AsyncJob.entity_id == 1).values(claimed_by='someone else'))
+    db.session.commit()
+
+    with patch.object(AsyncJobs, 'claim', return_value=jobs):
+        actual = AsyncJobs.run_due(executor=executor)
+
+    assert actual.total == 2
+    assert sorted(id for id, _ in RecordingJob.runs) == [0, 2]
+
+
+def test__run_due__stopped_early__claims_released(job_app):
+    add_jobs(1, job_class=InterruptedJob)
+    add_jobs(2, scheduled=past(seconds=30))
+
+    with pytest.raises(KeyboardInterrupt):
+        AsyncJobs.run_due()
+
+    assert RecordingJob.runs == []
+    assert AsyncJobs.due_count() == 2
+
+
+def test__drain__runs_everything(job_app):
+    add_jobs(250)
+
+    report, work_left = AsyncJobs.drain()
+
+    assert report.succeeded == 250
+    assert not work_left
+    assert AsyncJobs.due_count() == 0
+
+
+def test__drain__max_jobs(job_app):
+    add_jobs(250)
+
+    report, work_left = AsyncJobs.drain(max_jobs=120)
+
+    assert report.total == 120
+    assert work_left
+    assert AsyncJobs.due_count() == 130
+
+
+def test__drain__max_seconds__no_time__nothing_run(job_app):
+    add_jobs(150)
+
+    report, work_left = AsyncJobs.drain(max_seconds=0)
+
+    assert report.total == 0
+    assert work_left
+    assert AsyncJobs.due_count() == 150
+
+
+@pytest.mark.parametrize("executor", [AsyncJobs.EXECUTOR_SERIAL, AsyncJobs.EXECUTOR_THREAD])
+def test__drain__max_seconds__checked_per_job(job_app, executor):
+    add_jobs(3, job_class=SlowJob)
+
+    report, work_left = AsyncJobs.drain(max_seconds=0.1, executor=executor, max_workers=1)
+
+    assert report.total == 1
+    assert work_left
+    assert AsyncJobs.due_count() == 2
+
+
+def test__drain__failing_job_without_retry__run_once(job_app):
+    add_jobs(3, job_class=FailingJob)
+
+    report, work_left = AsyncJobs.drain()
+
+    assert report.failed == 3
+    assert not work_left
+    assert AsyncJobs.due_count() == 3
+
+
+def test__drain__only_failures_left__no_work_left(job_app):
+    add_jobs(3, job_class=FailingJob)
+
+    report, work_left = AsyncJobs.drain(max_jobs=3)
+
+    assert report.failed == 3
+    assert not work_left
+
+
+def test__run_jobs__work_left__reenqueued(job_app):
+    job_app.config['ASYNC_JOBS_DISPATCHER'] = 'celery'
+    job_app.config['ASYNC_JOBS_DRAIN_MAX_JOBS'] = 10
+    add_jobs(15)
+
+    with patch.object(_run_jobs, 'delay') as delay:
+        _run_jobs()
+
+    delay.assert_called_once()
+    assert AsyncJobs.due_count() == 5
+
+
+def test__run_jobs__finished__not_reenqueued(job_app):
+    job_app.config['ASYNC_JOBS_DISPATCHER'] = 'celery'
+    add_jobs(15)
+
+    with patch.object(_run_jobs, 'delay') as delay:
+        _run_jobs()
+
+    delay.assert_not_called()
+    assert AsyncJobs.due_count() == 0
+
+
+def test__run_jobs__only_failures__reenqueued(job_app):
+    job_app.config['ASYNC_JOBS_DISPATCHER'] = 'celery'
+    job_app.config['ASYNC_JOBS_DRAIN_MAX_JOBS'] = 2
+    add_jobs(5, job_class=FailingJob)
+
+    with patch.object(_run_jobs, 'delay') as delay:
+        _run_jobs()
+
+    delay.assert_called_once()
+
+
+def test__run_jobs__no_progress__not_reenqueued(job_app):
+    job_app.config['ASYNC_JOBS_DISPATCHER'] = 'celery'
+    job_app.config['ASYNC_JOBS_DRAIN_MAX_SECONDS'] = 0
+    add_jobs(5)
+
+    with patch.object(_run_jobs, 'delay') as delay:
+        _run_jobs()
+
+    delay.assert_not_called()
+    assert AsyncJobs.due_count() == 5
+
+
+def test__due__ordered_by_scheduled(job_app):
+    jobs = add_jobs(5)
+
+    for i, j in enumerate(jobs):
+        j.scheduled = past(minutes=i + 1)
+
+    db.session.commit()
+
+    assert [j.entity_id for j in AsyncJobs.due()] == [4, 3, 2, 1, 0]
+
+
+def test__due_batches__pages(job_app):
+    add_jobs(25, scheduled=past())
+
+    batches = list(AsyncJobs.due_batches(batch_size=10))
+
+    assert [len(b) for b in batches] == [10, 10, 5]
+    assert len({j.id for b in batches for j in b}) == 25
+
+
+def test__due_batches__excludes_claimed(job_app):
+    add_jobs(25)
+    AsyncJobs.claim(limit=5)
+
+    assert sum(len(b) for b in AsyncJobs.due_batches(batch_size=10)) == 20
+
+
+def test__due_batches__expunge(job_app):
+    add_jobs(25)
+
+    previous = None
+
+    for batch in AsyncJobs.due_batches(batch_size=10, expunge=True):
+        if previous:
+            assert all(j not in db.session for j in previous)
+
+        previous = batch
+
+
+def test__async_job__scheduled_index(job_app):
+    indexes = {i['name']: i['column_names'] for i in db.inspect(db.engine).get_indexes('async_job')}
+
+    assert indexes['ix__async_job__scheduled__job_type'] == ['scheduled', 'job_type']
+
+
+def all_jobs():
+    return {(j.entity_id, j.entity_id_string): j for j in db.session.execute(db.select(AsyncJob)).scalars()}
+
+
+def test__schedule_many__new_jobs(job_app):
+    scheduled = past()
+
+    AsyncJobs.schedule_many([RecordingJob(entity_id=i, scheduled=scheduled) for i in range(5)])
+    db.session.commit()
+
+    actual = all_jobs()
+
+    assert sorted(e for e, _ in actual) == [0, 1, 2, 3, 4]
+    assert all(j.job_type == 'test_recording' for j in actual.values())
+    assert all(j.retry is False for j in actual.values())
+
+
+def test__schedule_many__existing_jobs__rescheduled(job_app):
+    add_jobs(3)
+    for j in db.session.execute(db.select(AsyncJob)).scalars():
+        j.scheduled = None
+    db.session.commit()
+
+    AsyncJobs.schedule_many([
+        RecordingJob(entity_id=i, scheduled=past(), retry=True, retry_timedelta_period=AsyncJob.TIMEDELTA_HOURS, retry_timedelta_size=2)
+        for i in range(4)
+    ])
+    db.session.commit()
+    db.session.expire_all()
+
+    actual = all_jobs()
+
+    assert len(actual) == 4
+    assert all(j.scheduled is not None for j in actual.values())
+    assert all(j.retry_timedelta_size == 2 for j in actual.values())
+
+
+def test__schedule_many__recently_run__not_rescheduled(job_app):
+    now = datetime.now(timezone.utc)
+    db.session.add_all([
+        RecordingJob(entity_id=1, last_executed=now - timedelta(minutes=30)),
+        RecordingJob(entity_id=2, last_executed=now - timedelta(hours=3)),
+    ])
+    db.session.commit()
+
+    AsyncJobs.schedule_many([
+        RecordingJob(entity_id=i, scheduled=now, retry_timedelta_period=AsyncJob.TIMEDELTA_HOURS, retry_timedelta_size=1)
+        for i in [1, 2]
+    ])
+    db.session.commit()
+    db.session.expire_all()
+
+    actual = all_jobs()
+
+    assert actual[(1, None)].scheduled is None
+    assert actual[(2, None)].scheduled is not None
+
+
+def test__schedule_many__null_entity_ids__not_duplicated(job_app):
+    db.session.add_all([
+        RecordingJob(entity_id_string='a'),
+        RecordingJob(),
+    ])
+    db.session.commit()
+
+    AsyncJobs.schedule_many([
+        RecordingJob(entity_id_string='a', scheduled=past()),
+        RecordingJob(entity_id_string='b', scheduled=past()),
+        RecordingJob(scheduled=past()),
+    ])
+    db.session.commit()
+    db.session.expire_all()
+
+    actual = all_jobs()
+
+    assert set(actual) == {(None, 'a'), (None, 'b'), (None, None)}
+    assert all(j.scheduled is not None for j in actual.values())
+
+
+def test__schedule_many__duplicate_jobs__last_wins(job_app):
+    first = past(hours=2)
+    last = past(hours=1)
+
+    AsyncJobs.schedule_many([
+        RecordingJob(entity_id=1, scheduled=first),
+        RecordingJob(entity_id=1, scheduled=last),
+    ])
+    db.session.commit()
+
+    actual = all_jobs()
+
+    assert len(actual) == 1
+    assert actual[(1, None)].scheduled == last.replace(tzinfo=None)
+
+
+def test__schedule_many__chunked(job_app):
+    add_jobs(7)
+
+    AsyncJobs.schedule_many([RecordingJob(entity_id=i, scheduled=past()) for i in range(20)], chunk_size=3)
+    db.session.commit()
+
+    assert len(all_jobs()) == 20
+    assert AsyncJobs.due_count() == 20
+
+
+def test__schedule_many__other_job_type__not_updated(job_app):
+    db.session.add(FailingJob(entity_id=1))
+    db.session.commit()
+
+    AsyncJobs.schedule_many([RecordingJob(entity_id=1, scheduled=past())])
+    db.session.commit()
+
+    actual = db.session.execute(db.select(AsyncJob).order_by(AsyncJob.job_type)).scalars().all()
+
+    assert [(j.job_type, j.scheduled is None) for j in actual] == [('test_failing', True), ('test_recording', False)]
+
+
+def test__claim__priority__claimed_first(job_app):
+    add_jobs(5, scheduled=past(hours=1))
+    add_jobs(3, job_class=UrgentJob)
+
+    actual = AsyncJobs.claim(limit=4)
+
+    assert [j.job_type for j in actual] == ['test_urgent'] * 3 + ['test_recording']
+
+
+def test__claim__priority_from_config(job_app):
+    job_app.config['ASYNC_JOBS_PRIORITIES'] = {'test_urgent': -1}
+    add_jobs(2, job_class=UrgentJob, scheduled=past(hours=1))
+    add_jobs(2)
+
+    actual = AsyncJobs.claim(limit=2)
+
+    assert [j.job_type for j in actual] == ['test_recording'] * 2
+
+
+def test__claim__max_concurrent(job_app):
+    add_jobs(5, job_class=LimitedJob)
+    add_jobs(5)
+
+    first = AsyncJobs.claim()
+    second = AsyncJobs.claim()
+
+    assert [j.job_type for j in first].count('test_limited') == 2
+    assert [j.job_type for j in first].count('test_recording') == 5
+    assert second == []
+    assert AsyncJobs.running_counts() == {'test_limited': 2, 'test_recording': 5}
+
+
+def test__claim__max_concurrent__concurrent_workers__limit_kept(job_app):
+    add_jobs(20, job_class=LimitedJob)
+    ready = threading.Barrier(8)
+
+    def worker(_):
+        with job_app.app_context():
+            ready.wait()
+            claimed = [j.id for j in AsyncJobs.claim()]
+            db.session.remove()
+            return claimed
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(worker, range(8)))
+
+    assert sum(len(r) for r in results) == 2
+    assert AsyncJobs.running_counts() == {'test_limited': 2}
+
+
+def test__claim__max_concurrent__released_when_run(job_app):
+    add_jobs(5, job_class=LimitedJob)
+
+    for j in AsyncJobs.claim():
+        j.run()
+
+    assert len(AsyncJobs.claim()) == 2
+
+
+def test__claim__max_concurrent__expired_leases_not_counted(job_app):
+    add_jobs(5, job_class=LimitedJob)
+
+    AsyncJobs.claim(lease=timedelta(seconds=-1))
+
+    assert len(AsyncJobs.claim()) == 2
+
+
+def test__claim__max_concurrent_from_config(job_app):
+    job_app.config['ASYNC_JOBS_MAX_CONCURRENT'] = {'test_recording': 1, 'test_limited': None}
+    add_jobs(3)
+    add_jobs(3, job_class=LimitedJob)
+
+    actual = AsyncJobs.claim()
+
+    assert sorted(j.job_type for j in actual) == ['test_limited'] * 3 + ['test_recording']
+
+
+def test__drain__max_concurrent__all_run(job_app):
+    add_jobs(5, job_class=LimitedJob)
+
+    report, _ = AsyncJobs.drain()
+
+    assert report.succeeded == 5
+
+
+def failing_job(**kwargs):
+    return add_jobs(1, job_class=FailingJob, retry=True, **kwargs)[0]
+
+
+@pytest.mark.parametrize(
+    "period, expected",
+    [
+        (AsyncJob.TIMEDELTA_SECONDS, timedelta(seconds=5)),
+        (AsyncJob.TIMEDELTA_MINUTES, timedelta(minutes=5)),
+        (AsyncJob.TIMEDELTA_HOURS, timedelta(hours=5)),
+        (AsyncJob.TIMEDELTA_DAYS, timedelta(days=5)),
+    ],
+)
+def test__retry_delay__periods(job_app, period, expected):
+    j = FailingJob(retry_timedelta_period=period, retry_timedelta_size=5)
+
+    assert j.retry_delay() == expected
+
+
+@pytest.mark.parametrize(
+    "attempts, expected_minutes",
+    [(1, 1), (2, 2), (3, 4), (5, 16), (20, 60), (1000, 60)],
+)
+def test__retry_delay__backoff(job_app, attempts, expected_minutes):
+    j = FailingJob(retry_timedelta_period=AsyncJob.TIMEDELTA_MINUTES, retry_timedelta_size=1, retry_backoff=True, attempts=attempts)
+    j.retry_backoff_cap = timedelta(hours=1)
+
+    for _ in range(20):
+        actual = j.retry_delay()
+
+        assert timedelta(minutes=expected_minutes) * (1 - j.retry_jitter) <= actual <= timedelta(minutes=expected_minutes)
+
+
+def test__retry_delay__jitter_spreads_retries(job_app):
+    j = FailingJob(retry_timedelta_period=AsyncJob.TIMEDELTA_MINUTES, retry_timedelta_size=10, retry_backoff=True, attempts=1)
+
+    assert len({j.retry_delay() for _ in range(20)}) > 1
+
+
+def test__run__failed__attempts_counted_and_backed_off(job_app):
+    j = failing_job(retry_timedelta_period=AsyncJob.TIMEDELTA_MINUTES, retry_timedelta_size=10, retry_backoff=True)
+
+    j.run()
+    first = j.scheduled - j.last_executed
+    j.run()
+    second = j.scheduled - j.last_executed
+
+    assert j.attempts == 2
+    assert first <= timedelta(minutes=10)
+    assert second > timedelta(minutes=10)
+
+
+def test__run__max_attempts__dead(job_app):
+    j = failing_job(retry_timedelta_period=AsyncJob.TIMEDELTA_SECONDS, retry_timedelta_size=1, max_attempts=2)
+
+    j.run()
+
+    assert not j.dead
+    assert j.scheduled is not None
+
+    j.run()
+
+    assert j.dead
+    assert j.scheduled is None
+    assert AsyncJobs.due_count() == 0
+
+
+def test__run__succeeded__attempts_reset(job_app):
+    j = add_jobs(1, attempts=3)[0]
+
+    j.run()
+
+    assert j.attempts == 0
+
+
+def test__async_job__inserted_without_new_columns__server_defaults(job_app):
+    # As by an application that predates the columns
+    db.session.execute(db.insert(AsyncJob.__table__).values(job_type='test_recording', entity_id=1, scheduled=past(), retry=False))
+    db.session.commit()
+
+    j = db.session.execute(db.select(AsyncJob)).scalar_one()
+
+    assert j.attempts == 0
+    assert j.dead is False
+    assert j.retry_backoff is False
+
+
+def test__schedule__dead_job__revived(job_app):
+    j = failing_job(max_attempts=1)
+    j.run()
+
+    AsyncJobs.schedule(FailingJob(entity_id=j.entity_id, scheduled=datetime.now(timezone.utc), max_attempts=3))
+    db.session.commit()
+
+    assert not j.dead
+    assert j.attempts == 0
+    assert j.max_attempts == 3
+    assert j.scheduled is not None
+
+
+def test__schedule_many__dead_job__revived(job_app):
+    j = failing_job(max_attempts=1)
+    j.run()
+
+    AsyncJobs.schedule_many([FailingJob(entity_id=j.entity_id, scheduled=datetime.now(timezone.utc))])
+    db.session.commit()
+    db.session.expire_all()
+
+    assert not j.dead
+    assert j.attempts == 0
+    assert j.scheduled is not None
+
+
+def runs():
+    return db.session.execute(db.select(AsyncJobRun).order_by(AsyncJobRun.id)).scalars().all()
+
+
+def test__run__records_run(job_app):
+    add_jobs(1, scheduled=past(minutes=5))
+    failing_job()
+
+    AsyncJobs.run_due()
+
+    actual = runs()
+
+    assert [(r.job_type, r.succeeded, r.attempt, r.error) for r in actual] == [
+        ('test_recording', True, 1, None),
+        ('test_failing', False, 1, 'Broken'),
+    ]
+    assert all(r.duration >= 0 for r in actual)
+    assert all(r.ended >= r.started for r in actual)
+    assert 5 * 60 <= actual[0].queue_lag < 6 * 60
+
+
+def test__run__retried__attempt_recorded(job_app):
+    j = failing_job(retry_timedelta_period=AsyncJob.TIMEDELTA_SECONDS, retry_timedelta_size=1)
+
+    j.run()
+    j.run()
+
+    assert [r.attempt for r in runs()] == [1, 2]
+
+
+def test__run__telemetry_disabled(job_app):
+    job_app.config['ASYNC_JOBS_TELEMETRY'] = False
+    add_jobs(2)
+
+    AsyncJobs.run_due()
+
+    assert runs() == []
+
+
+def test__statistics(job_app):
+    now = datetime.now(timezone.utc)
+
+    db.session.add_all(
+        [AsyncJobRun(async_job_id=1, job_type='a', attempt=1, started=now, ended=now, duration=d, succeeded=True, queue_lag=d * 10) for d in range(1, 101)] +
+        [AsyncJobRun(async_job_id=2, job_type='b', attempt=1, started=now, ended=now, duration=1000, succeeded=False)] +
+        [AsyncJobRun(async_job_id=3, job_type='c', attempt=1, started=past(days=2), ended=now, duration=1, succeeded=True)]
+    )
+    db.session.commit()
+
+    actual = AsyncJobs.statistics()
+
+    assert [s['job_type'] for s in actual] == ['a', 'b']
+    assert actual[0]['runs'] == 100
+    assert actual[0]['p50_seconds'] == 50
+    assert actual[0]['p95_seconds'] == 95
+    assert actual[0]['max_seconds'] == 100
+    assert actual[0]['p95_queue_lag_seconds'] == 950
+    assert actual[1]['failed'] == 1
+    assert actual[1]['p95_queue_lag_seconds'] is None
+
+
+def test__due_lag(job_app):
+    assert AsyncJobs.due_lag() == 0
+
+    add_jobs(1, scheduled=past(minutes=10))
+    add_jobs(1, scheduled=past(minutes=1))
+
+    assert 10 * 60 <= AsyncJobs.due_lag() < 11 * 60
+
+
+def test__heartbeat__extends_lease(job_app):
+    add_jobs(1)
+    j = AsyncJobs.claim(lease=timedelta(seconds=-1))[0]
+
+    assert j.heartbeat(lease=timedelta(hours=1))
+
+    db.session.refresh(j)
+
+    assert j.lease_expires > datetime.now() + timedelta(minutes=59)
+    assert AsyncJobs.abandoned() == []
+
+
+def test__heartbeat__extends_whole_claim(job_app):
+    add_jobs(3)
+    j = AsyncJobs.claim(lease=timedelta(seconds=-1))[0]
+
+    assert j.heartbeat(lease=timedelta(hours=1))
+    assert AsyncJobs.abandoned() == []
+
+
+def test__heartbeat__waiting_leases_not_shortened(job_app):
+    add_jobs(3)
+    jobs = AsyncJobs.claim(lease=timedelta(hours=1))
+    ids = [j.id for j in jobs]
+
+    assert jobs[0].heartbeat(lease=timedelta(seconds=-1))
+
+    assert [j.id for j in AsyncJobs.abandoned()] == ids[:1]
+
+
+def test__heartbeat__claimed_by_another_worker(job_app):
+    add_jobs(1)
+    j = AsyncJobs.claim()[0]
+    j.claimed_by = 'someone else'
+
+    assert not j.heartbeat()
+
+
+def test__heartbeat__job_reaped__claim_not_extended(job_app):
+    add_jobs(2)
+    jobs = AsyncJobs.claim(lease=timedelta(seconds=-1))
+    claimed_by = jobs[0].claimed_by
+    db.session.execute(db.update(AsyncJob).where(AsyncJob.id == jobs[0].id).values(claimed_by=None))
+    db.session.commit()
+
+    assert not _extend_lease(db.engine, jobs[0].id, claimed_by, timedelta(hours=1))
+    assert [j.id for j in AsyncJobs.abandoned()] == [jobs[1].id]
+
+
+def test__run__heartbeat__waiting_jobs_not_reaped(job_app):
+    job_app.config['ASYNC_JOBS_HEARTBEAT_SECONDS'] = 0.1
+    add_jobs(1, job_class=SlowJob)
+    add_jobs(1, scheduled=past(seconds=30))
+    jobs = AsyncJobs.claim(lease=timedelta(seconds=0.2))
+
+    jobs[0].run()
+
+    assert AsyncJobs.abandoned() == []
+
+
+def test__run__heartbeats_while_running(job_app):
+    job_app.config['ASYNC_JOBS_HEARTBEAT_SECONDS'] = 0.1
+    SlowJob.leases = []
+    add_jobs(1, job_class=SlowJob)
+
+    AsyncJobs.run_due(lease=timedelta(seconds=-1))
+
+    assert SlowJob.leases[0] > datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=0.5)
+    assert not any(t.name.startswith('async_job_heartbeat') for t in threading.enumerate())
+
+
+def test__run_due__asyncio_jobs__heartbeats_while_running(job_app):
+    job_app.config['ASYNC_JOBS_HEARTBEAT_SECONDS'] = 0.1
+    SlowAsyncJob.leases = []
+    add_jobs(2, job_class=SlowAsyncJob)
+
+    AsyncJobs.run_due(lease=timedelta(seconds=-1))
+
+    assert len(SlowAsyncJob.leases) == 2
+    assert all(l > datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=0.5) for l in SlowAsyncJob.leases)
+    assert not any(t.name.startswith('async_job_heartbeat') for t in threading.enumerate())
+
+
+def test__reap__abandoned_jobs_requeued(job_app):
+    add_jobs(2)
+    AsyncJobs.claim(lease=timedelta(seconds=-1))
+
+    assert len(AsyncJobs.abandoned()) == 2
+    assert AsyncJobs.reap() == 2
+
+    db.session.expire_all()
+
+    for j in db.session.execute(db.select(AsyncJob)).scalars():
+        assert j.claimed_by is None
+        assert j.lease_expires is None
+        assert j.attempts == 1
+        assert j.error.startswith('Abandoned by ')
+
+    assert AsyncJobs.due_count() == 2
+
+
+def test__reap__out_of_attempts__dead(job_app):
+    add_jobs(1, max_attempts=1)
+    AsyncJobs.claim(lease=timedelta(seconds=-1))
+
+    AsyncJobs.reap()
+
+    j = db.session.execute(db.select(AsyncJob)).scalar_one()
+
+    assert j.dead
+    assert j.scheduled is None
+
+
+def test__reap__live_claims_untouched(job_app):
+    add_jobs(2)
+    AsyncJobs.claim()
+
+    assert AsyncJobs.reap() == 0
+    assert AsyncJobs.running_counts() == {'test_recording': 2}
+
+
+def test__run_jobs__reaps_abandoned_jobs(job_app):
+    add_jobs(2)
+    AsyncJobs.claim(lease=timedelta(seconds=-1))
+
+    _run_jobs()
+
+    assert AsyncJobs.due_count() == 0
+    assert len(RecordingJob.runs) == 2
+
+
+def add_completed_jobs(count, last_executed, **kwargs):
+    jobs = [RecordingJob(entity_id=i, last_executed=last_executed, error='', **kwargs) for i in range(count)]
+    db.session.add_all(jobs)
+    db.session.commit()
+
+    return jobs
+
+
+def count(model):
+    return db.session.execute(db.select(db.func.count()).select_from(model)).scalar()
+
+
+def test__archive_completed__old_completed_jobs_archived(job_app):
+    add_completed_jobs(7, last_executed=past(days=100))
+
+    assert AsyncJobs.archive_completed(batch_size=3) == 7
+
+    assert count(AsyncJob) == 0
+    archived = db.session.execute(db.select(AsyncJobArchive).order_by(AsyncJobArchive.entity_id)).scalars().all()
+    assert [a.entity_id for a in archived] == list(range(7))
+    assert all(a.job_type == 'test_recording' and a.archived for a in archived)
+
+
+def test__archive_completed__delete(job_app):
+    add_completed_jobs(3, last_executed=past(days=100))
+
+    assert AsyncJobs.archive_completed(archive=False) == 3
+
+    assert count(AsyncJob) == 0
+    assert count(AsyncJobArchive) == 0
+
+
+def test__archive_completed__retention(job_app):
+    job_app.config['ASYNC_JOBS_RETENTION_DAYS'] = 10
+    add_completed_jobs(3, last_executed=past(days=11))
+    db.session.add(RecordingJob(entity_id=99, last_executed=past(days=9), error=''))
+    db.session.commit()
+
+    assert AsyncJobs.archive_completed() == 3
+    assert count(AsyncJob) == 1
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {'scheduled': past()},
+        {'error': 'Broken'},
+        {'dead': True, 'error': None},
+        {'claimed_by': 'worker'},
+    ],
+)
+def test__archive_completed__not_completed__kept(job_app, kwargs):
+    j = RecordingJob(entity_id=1, last_executed=past(days=100), error='')
+
+    for k, v in kwargs.items():
+        setattr(j, k, v)
+
+    db.session.add(j)
+    db.session.commit()
+
+    assert AsyncJobs.archive_completed() == 0
+    assert count(AsyncJob) == 1
+
+
+def test__prune_runs(job_app):
+    now = datetime.now(timezone.utc)
+    db.session.add_all([
+        AsyncJobRun(async_job_id=i, job_type='a', attempt=1, started=started, ended=now, duration=1, succeeded=True)
+        for i, started in enumerate([past(days=100)] * 5 + [now])
+    ])
+    db.session.commit()
+
+    assert AsyncJobs.prune_runs(batch_size=2) == 5
+    assert count(AsyncJobRun) == 1
+
+
+def test__archive_jobs_task(job_app):
+    add_completed_jobs(2, last_executed=past(days=100))
+
+    _archive_jobs()
+
+    assert count(AsyncJobArchive) == 2
+
+
+def test__archive_jobs_task__retention_disabled(job_app):
+    job_app.config['ASYNC_JOBS_RETENTION_DAYS'] = 0
+    add_completed_jobs(2, last_executed=past(days=100))
+
+    _archive_jobs()
+
+    assert count(AsyncJob) == 2
+
+
+@pytest.mark.parametrize("minutes", [None, 0])
+def test__schedule_archive_jobs__not_configured__not_scheduled(minutes):
+    sender = MagicMock(conf={'async_jobs_archive_interval_minutes': minutes})
+
+    _schedule_archive_jobs(sender)
+
+    sender.add_periodic_task.assert_not_called()
+
+
+def test__schedule_archive_jobs__configured__scheduled():
+    sender = MagicMock(conf={'async_jobs_archive_interval_minutes': 30})
+
+    _schedule_archive_jobs(sender)
+
+    assert sender.add_periodic_task.call_args.args[0] == timedelta(minutes=30)
+
+
+def test__job_dispatcher__no_broker__thread(job_app):
+    assert isinstance(job_dispatcher(), ThreadJobDispatcher)
+    assert job_dispatcher() is job_dispatcher()
+
+
+def test__run_jobs_asynch__broker__celery(job_app):
+    job_app.config['BROKER_URL'] = 'redis://localhost'
+
+    with patch.object(_run_jobs, 'delay') as delay:
+        run_jobs_asynch()
+
+    delay.assert_called_once()
+
+
+def test__run_jobs_asynch__custom_dispatcher(job_app):
+    dispatcher = MagicMock()
+    job_app.config['ASYNC_JOBS_DISPATCHER'] = dispatcher
+
+    run_jobs_asynch()
+
+    dispatcher.dispatch.assert_called_once()
+
+
+def test__run_jobs_asynch__unknown_dispatcher(job_app):
+    job_app.config['ASYNC_JOBS_DISPATCHER'] = 'carrier_pigeon'
+
+    with pytest.raises(ValueError):
+        run_jobs_asynch()
+
+
+def test__run_jobs_asynch__no_broker__runs_in_background(job_app):
+    add_jobs(5)
+
+    assert run_jobs_asynch()
+
+    job_dispatcher().shutdown()
+
+    assert AsyncJobs.due_count() == 0
+    assert all(name.startswith('async_job_dispatcher') for _, name in RecordingJob.runs)
+
+
+def test__thread_dispatcher__queue_bounded(job_app):
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    def blocking_drain():
+        started.release()
+        release.wait(5)
+
+    out = ThreadJobDispatcher(job_app, max_workers=1, max_queue=1)
+
+    with patch('lbrc_flask.async_jobs._drain', side_effect=blocking_drain) as drain:
+        assert out.dispatch()
+        assert started.acquire(timeout=5)
+
+        assert out.dispatch()
+        assert not out.dispatch()
+
+        release.set()
+        assert started.acquire(timeout=5)
+        out.shutdown()
+
+    assert drain.call_count == 2
+    assert not out.dispatch()
+
+
+def test__thread_dispatcher__shutdown__waiting_drains_cancelled(job_app):
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking_drain():
+        started.set()
+        release.wait(5)
+
+    out = ThreadJobDispatcher(job_app, max_workers=1, max_queue=2)
+
+    with patch('lbrc_flask.async_jobs._drain', side_effect=blocking_drain) as drain:
+        out.dispatch()
+        started.wait(5)
+        out.dispatch()
+
+        threading.Timer(0.2, release.set).start()
+        out.shutdown()
+
+    assert drain.call_count == 1
+
+
+def test__asyncio_job__run(job_app):
+    j = add_jobs(1, job_class=SleepingJob)[0]
+
+    assert j.run()
+    assert SleepingJob.saved == [0]
+
+
+def test__run_due__asyncio_jobs__run_concurrently(job_app):
+    add_jobs(10, job_class=SleepingJob)
+
+    start = time.perf_counter()
+    actual = AsyncJobs.run_due()
+    elapsed = time.perf_counter() - start
+
+    assert actual.succeeded == 10
+    assert elapsed < 1
+    assert sorted(SleepingJob.saved) == [i * 10 for i in range(10)]
+    assert AsyncJobs.due_count() == 0
+    assert all(r.succeeded and r.duration < 1 for r in runs())
+
+
+def test__run_due__asyncio_jobs__concurrency_limited(job_app):
+    job_app.config['ASYNC_JOBS_ASYNCIO_CONCURRENCY'] = 3
+    add_jobs(7, job_class=SleepingJob)
+
+    AsyncJobs.run_due()
+
+    assert SleepingJob.max_running == 3
+
+
+def test__run_due__asyncio_jobs__failures(job_app):
+    add_jobs(3, job_class=SleepingJob)
+    db.session.add_all([
+        SleepingJob(entity_id=10, entity_id_string='fail', scheduled=past()),
+        SleepingJob(entity_id=11, entity_id_string='fail_save', scheduled=past()),
+    ])
+    db.session.commit()
+
+    actual = AsyncJobs.run_due()
+
+    assert actual.succeeded == 3
+    assert actual.failed == 2
+    assert sorted(SleepingJob.saved) == [0, 10, 20]
+
+    errors = dict(db.session.execute(db.select(AsyncJob.entity_id_string, AsyncJob.error).where(AsyncJob.entity_id >= 10)).all())
+    assert errors == {'fail': 'Broken', 'fail_save': 'Not saved'}
+
+
+def test__run_due__asyncio_and_other_jobs(job_app):
+    add_jobs(3, job_class=SleepingJob)
+    add_jobs(3)
+
+    actual = AsyncJobs.run_due()
+
+    assert actual.succeeded == 6
+    assert len(RecordingJob.runs) == 3
+
+
+def scheduled_for(entity_id):
+    db.session.expire_all()
+
+    return db.session.execute(db.select(AsyncJob.scheduled).where(AsyncJob.entity_id == entity_id)).scalar()
+
+
+@pytest.mark.parametrize("schedule", [AsyncJobs.schedule, lambda j: AsyncJobs.schedule_many([j])])
+def test__schedule__coalesce_window__delayed(job_app, schedule):
+    now = datetime.now(timezone.utc)
+
+    schedule(CoalescedJob(entity_id=1, scheduled=now))
+    db.session.commit()
+
+    assert scheduled_for(1) == (now + timedelta(minutes=5)).replace(tzinfo=None)
+
+
+@pytest.mark.parametrize("schedule", [AsyncJobs.schedule, lambda j: AsyncJobs.schedule_many([j])])
+def test__schedule__coalesce_window__merged(job_app, schedule):
+    now = datetime.now(timezone.utc)
+
+    for i in range(4):
+        schedule(CoalescedJob(entity_id=1, scheduled=now + timedelta(minutes=i)))
+        db.session.commit()
+
+    assert scheduled_for(1) == (now + timedelta(minutes=5)).replace(tzinfo=None)
+    assert len(all_jobs()) == 1
+
+
+@pytest.mark.parametrize("schedule", [AsyncJobs.schedule, lambda j: AsyncJobs.schedule_many([j])])
+def test__schedule__coalesce_window__later_run_brought_forward(job_app, schedule):
+    now = datetime.now(timezone.utc)
+    db.session.add(CoalescedJob(entity_id=1, scheduled=now + timedelta(hours=1)))
+    db.session.commit()
+
+    schedule(CoalescedJob(entity_id=1, scheduled=now))
+    db.session.commit()
+
+    assert scheduled_for(1) == (now + timedelta(minutes=5)).replace(tzinfo=None)
+
+
+@pytest.mark.parametrize("schedule", [AsyncJobs.schedule, lambda j: AsyncJobs.schedule_many([j])])
+def test__schedule__coalesce_window__after_run__new_window(job_app, schedule):
+    now = datetime.now(timezone.utc)
+    db.session.add(CoalescedJob(entity_id=1, last_executed=now - timedelta(hours=1)))
+    db.session.commit()
+
+    schedule(CoalescedJob(entity_id=1, scheduled=now))
+    db.session.commit()
+
+    assert scheduled_for(1) == (now + timedelta(minutes=5)).replace(tzinfo=None)
+
+
+def test__schedule__coalesce_window_from_config(job_app):
+    job_app.config['ASYNC_JOBS_COALESCE_WINDOWS'] = {'test_recording': 60, 'test_coalesced': None}
+    now = datetime.now(timezone.utc)
+
+    AsyncJobs.schedule(RecordingJob(entity_id=1, scheduled=now))
+    AsyncJobs.schedule(CoalescedJob(entity_id=2, scheduled=now))
+    db.session.commit()
+
+    assert scheduled_for(1) == (now + timedelta(seconds=60)).replace(tzinfo=None)
+    assert scheduled_for(2) == now.replace(tzinfo=None)
+
+
+def test__schedule__no_coalesce_window__rescheduled(job_app):
+    now = datetime.now(timezone.utc)
+
+    AsyncJobs.schedule(RecordingJob(entity_id=1, scheduled=now + timedelta(minutes=5)))
+    db.session.commit()
+    AsyncJobs.schedule(RecordingJob(entity_id=1, scheduled=now + timedelta(minutes=10)))
+    db.session.commit()
+
+    assert scheduled_for(1) == (now + timedelta(minutes=10)).replace(tzinfo=None)
+
+
+@pytest.fixture(scope="function")
+def eager_celery(job_app):
+    previous = dict(celery.conf)
+    celery.conf.update(task_always_eager=True, result_backend='cache+memory://')
+    job_app.config['ASYNC_JOBS_DISPATCHER'] = 'celery_fan_out'
+
+    yield celery
+
+    celery.conf.update(task_always_eager=previous.get('task_always_eager'), result_backend=previous.get('result_backend'))
+
+
+def test__job_dispatcher__celery_fan_out(job_app):
+    job_app.config['ASYNC_JOBS_DISPATCHER'] = 'celery_fan_out'
+
+    assert isinstance(job_dispatcher(), CeleryFanOutJobDispatcher)
+
+
+def test__run_job_chunk(job_app):
+    add_jobs(3)
+    add_jobs(1, job_class=FailingJob)
+    jobs = AsyncJobs.claim()
+
+    actual = _run_job_chunk(jobs[0].claimed_by, [j.id for j in jobs])
+
+    assert actual['succeeded'] == 3
+    assert actual['failed'] == 1
+
+
+def test__run_job_chunk__no_longer_claimed__skipped(job_app):
+    add_jobs(3)
+    jobs = AsyncJobs.claim()
+
+    actual = _run_job_chunk('someone else', [j.id for j in jobs] + [999])
+
+    assert actual == {'succeeded': 0, 'failed': 0, 'seconds': actual['seconds']}
+    assert RecordingJob.runs == []
+
+
+def test__report_job_chunks__totals(job_app):
+    with patch('lbrc_flask.async_jobs.run_jobs_asynch') as run_jobs_asynch:
+        actual = _report_job_chunks([
+            {'succeeded': 3, 'failed': 1, 'seconds': 1.5},
+            {'succeeded': 2, 'failed': 0, 'seconds': 0.5},
+        ])
+
+    assert actual == {'chunks': 2, 'succeeded': 5, 'failed': 1, 'seconds': 2.0}
+    run_jobs_asynch.assert_not_called()
+
+
+def test__report_job_chunks__jobs_due__fans_out_again(job_app):
+    add_jobs(1)
+
+    with patch('lbrc_flask.async_jobs.run_jobs_asynch') as run_jobs_asynch:
+        _report_job_chunks([{'succeeded': 1, 'failed': 0, 'seconds': 1}])
+
+    run_jobs_asynch.assert_called_once()
+
+
+def test__fan_out_jobs__chunks(job_app, eager_celery):
+    job_app.config['ASYNC_JOBS_FAN_OUT_CHUNK_SIZE'] = 4
+    job_app.config['ASYNC_JOBS_FAN_OUT_MAX_JOBS'] = 10
+    add_jobs(25)
+
+    with patch.object(_run_job_chunk, 's', wraps=_run_job_chunk.s) as chunk:
+        run_jobs_asynch()
+
+    assert [len(c.args[1]) for c in chunk.call_args_list][:3] == [4, 4, 2]
+    assert AsyncJobs.due_count() == 0
+    assert sorted(id for id, _ in RecordingJob.runs) == list(range(25))
@@ -1,8 +1,11 @@
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 import pytest
 from unittest.mock import patch
 
-from lbrc_flask.caching import timed_cache
+from lbrc_flask.caching import timed_cache, cache_statistics
 
 @pytest.fixture(scope="function")
 def mock_y():
@@ -42,9 +45,239 @@ def test__timed_cache__cache_timed_out__caching_restarts(mock_y):
     assert mock_y.call_count == 2
 
 
+def test__timed_cache__entries_expire_individually(mock_y):
+    x_args(1)
+    time.sleep(1)
+    x_args(2)
+    time.sleep(0.5)
+    x_args(1)
+    x_args(2)
+
+    assert mock_y.call_count == 3
+
+
+def test__timed_cache__maxsize_reached__least_recently_used_evicted(mock_y):
+    x_small(1)
+    x_small(2)
+    x_small(1)
+    x_small(3)
+    x_small(1)
+    x_small(2)
+
+    assert mock_y.call_count == 4
+
+
+def test__timed_cache__cache_clear(mock_y):
+    x_args(10)
+    x_args.cache_clear()
+    x_args(10)
+
+    assert mock_y.call_count == 2
+
+
 @timed_cache(seconds=1)
 def x():
     return y()
 
+
+@timed_cache(seconds=1.2)
+def x_args(a):
+    return y()
+
+
+@timed_cache(maxsize=2, seconds=10)
+def x_small(a):
+    return y()
+
 def y():
-    return 3
\ No newline at end of file
+    return 3
+
+def test__timed_cache__single_flight__concurrent_calls__run_once(mock_y):
+    def slow():
+        time.sleep(0.2)
+        return 3
+
+    mock_y.side_effect = slow
+
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        results = list(executor.map(lambda _: x_single_flight(1), range(100)))
+
+    assert results == [3] * 100
+    mock_y.assert_called_once()
+
+
+def test__timed_cache__single_flight__expired__stale_value_served_while_recomputing(mock_y):
+    started = threading.Event()
+    release = threading.Event()
+
+    mock_y.return_value = 1
+    x_single_flight(2)
+
+    def slow():
+        started.set()
+        release.wait()
+        return 2
+
+    mock_y.side_effect = slow
+    time.sleep(1.1)
+
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        leader = executor.submit(x_single_flight, 2)
+        started.wait()
+
+        others = list(executor.map(lambda _: x_single_flight(2), range(50)))
+
+        release.set()
+
+        assert leader.result() == 2
+
+    assert others == [1] * 50
+    assert mock_y.call_count == 2
+
+
+def test__timed_cache__single_flight__exception__raised_for_waiters(mock_y):
+    def fail():
+        time.sleep(0.2)
+        raise ValueError('Broken')
+
+    mock_y.side_effect = fail
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        futures = [executor.submit(x_single_flight, 3) for _ in range(10)]
+
+    for f in futures:
+        with pytest.raises(ValueError):
+            f.result()
+
+    mock_y.assert_called_once()
+
+
+@timed_cache(seconds=1, single_flight=True)
+def x_single_flight(a):
+    return y()
+
+
+def test__timed_cache__stale_while_revalidate__stale_value_served_and_refreshed(mock_y):
+    release = threading.Event()
+
+    mock_y.return_value = 1
+    x_stale_while_revalidate(1)
+
+    def slow():
+        release.wait()
+        return 2
+
+    mock_y.side_effect = slow
+    time.sleep(1.1)
+
+    results = [x_stale_while_revalidate(1) for _ in range(20)]
+
+    release.set()
+    time.sleep(0.2)
+
+    assert results == [1] * 20
+    assert x_stale_while_revalidate(1) == 2
+    assert mock_y.call_count == 2
+
+
+def test__timed_cache__stale_while_revalidate__grace_passed__recomputed(mock_y):
+    mock_y.return_value = 1
+    x_stale_while_revalidate(2)
+
+    mock_y.return_value = 2
+    time.sleep(2.1)
+
+    assert x_stale_while_revalidate(2) == 2
+    assert mock_y.call_count == 2
+
+
+def test__timed_cache__stale_while_revalidate__refresh_fails__stale_value_kept(mock_y):
+    mock_y.return_value = 1
+    x_stale_while_revalidate(3)
+
+    mock_y.side_effect = ValueError('Broken')
+    time.sleep(1.1)
+
+    assert x_stale_while_revalidate(3) == 1
+    time.sleep(0.2)
+    assert x_stale_while_revalidate(3) == 1
+
+
+@timed_cache(seconds=1, stale_while_revalidate=timedelta(seconds=1))
+def x_stale_while_revalidate(a):
+    return y()
+
+
+def test__timed_cache__statistics(mock_y):
+    x_statistics.cache_statistics.reset()
+
+    x_statistics(1)
+    x_statistics(1)
+    x_statistics(2)
+    x_statistics(3)
+    time.sleep(1.1)
+    x_statistics(3)
+
+    actual = x_statistics.cache_info()
+
+    assert actual['name'] == 'tests.test__caching.x_statistics'
+    assert actual['hits'] == 1
+    assert actual['misses'] == 4
+    assert actual['expirations'] == 1
+    assert actual['evictions'] == 1
+    assert actual['size'] == 2
+    assert actual['computations'] == 4
+    assert actual['average_compute_seconds'] is not None
+
+
+def test__cache_statistics__includes_all_cached_functions():
+    names = [s['name'] for s in cache_statistics()]
+
+    assert 'tests.test__caching.x' in names
+    assert 'tests.test__caching.x_statistics' in names
+
+
+@timed_cache(maxsize=2, seconds=1)
+def x_statistics(a):
+    return y()
+
+
+def test__timed_cache__maxbytes__least_recently_used_evicted(mock_y):
+    mock_y.side_effect = lambda: 'x' * 40
+
+    x_maxbytes(1)
+    x_maxbytes(2)
+    x_maxbytes(1)
+    x_maxbytes(3)
+    x_maxbytes(1)
+    x_maxbytes(2)
+
+    assert mock_y.call_count == 4
+    assert x_maxbytes.cache_info()['size_bytes'] == 80
+
+
+def test__timed_cache__maxbytes__value_too_large__not_cached(mock_y):
+    mock_y.side_effect = lambda: 'x' * 101
+
+    x_maxbytes(4)
+    x_maxbytes(4)
+
+    assert mock_y.call_count == 2
+
+
+def test__timed_cache__maxbytes__default_sizer(mock_y):
+    mock_y.return_value = list(range(1000))
+
+    x_maxbytes_pickled(1)
+
+    assert 0 < x_maxbytes_pickled.cache_info()['size_bytes'] <= 10_000
+
+
+@timed_cache(seconds=10, maxbytes=100, sizer=len)
+def x_maxbytes(a):
+    return y()
+
+
+@timed_cache(seconds=10, maxbytes=10_000)
+def x_maxbytes_pickled(a):
+    return y()
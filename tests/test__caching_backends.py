@@ -0,0 +1,288 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from unittest.mock import MagicMock
+
+from lbrc_flask.caching import timed_cache, CacheBackend, MemoryCacheBackend, SqliteCacheBackend, RemoteCacheBackend
+
+
+class FakeRemoteClient:
+    def __init__(self):
+        self.values = {}
+        self.expiries = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, expire=None):
+        self.values[key] = value
+        self.expiries[key] = expire
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+def _cached(backend, func, **kwargs):
+    return timed_cache(seconds=10, backend=backend, namespace='tests.shared', **kwargs)(func)
+
+
+def test__sqlite_backend__shared_between_workers(tmp_path):
+    path = tmp_path / 'cache.db'
+    worker_1 = MagicMock(return_value=[1, 2, 3])
+    worker_2 = MagicMock(return_value=[4, 5, 6])
+
+    assert _cached(SqliteCacheBackend(path), worker_1)('a', b=2) == [1, 2, 3]
+    assert _cached(SqliteCacheBackend(path), worker_2)('a', b=2) == [1, 2, 3]
+
+    worker_1.assert_called_once()
+    worker_2.assert_not_called()
+
+
+def test__sqlite_backend__shared_between_processes(tmp_path):
+    path = tmp_path / 'cache.db'
+
+    subprocess.run(
+        [
+            sys.executable,
+            '-c',
+            'from lbrc_flask.caching import timed_cache, SqliteCacheBackend;'
+            f'timed_cache(seconds=10, backend=SqliteCacheBackend({str(path)!r}), namespace="tests.shared")(lambda a: a * 2)(21)',
+        ],
+        check=True,
+    )
+
+    func = MagicMock(return_value=0)
+
+    assert _cached(SqliteCacheBackend(path), func)(21) == 42
+    func.assert_not_called()
+
+
+def test__sqlite_backend__init__no_connection_kept(tmp_path):
+    backend = SqliteCacheBackend(tmp_path / 'cache.db')
+
+    assert getattr(backend._local, 'conn', None) is None
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Needs fork')
+def test__sqlite_backend__forked__new_connection(tmp_path):
+    backend = SqliteCacheBackend(tmp_path / 'cache.db')
+    cached = _cached(backend, lambda a: a * 2)
+    cached(1)
+    parent_connection = backend.connection()
+
+    pid = os.fork()
+
+    if pid == 0:
+        os._exit(0 if cached(2) == 4 and backend.connection() is not parent_connection else 1)
+
+    _, status = os.waitpid(pid, 0)
+
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert cached(2) == 4
+
+
+def test__sqlite_backend__expired__recalculated(tmp_path):
+    func = MagicMock(side_effect=[1, 2])
+    cached = timed_cache(seconds=1, backend=SqliteCacheBackend(tmp_path / 'cache.db'), namespace='tests.expiry')(func)
+
+    assert cached(1) == 1
+    time.sleep(1.1)
+    assert cached(1) == 2
+
+
+def test__sqlite_backend__maxsize_reached__least_recently_used_evicted(tmp_path):
+    func = MagicMock(side_effect=lambda a: a)
+    cached = _cached(SqliteCacheBackend(tmp_path / 'cache.db', touch_interval=0), func, maxsize=2)
+
+    cached(1)
+    time.sleep(0.01)
+    cached(2)
+    time.sleep(0.01)
+    cached(1)
+    time.sleep(0.01)
+    cached(3)
+    cached(1)
+    cached(2)
+
+    assert func.call_count == 4
+
+
+def test__sqlite_backend__cache_clear(tmp_path):
+    func = MagicMock(return_value=1)
+    cached = _cached(SqliteCacheBackend(tmp_path / 'cache.db'), func)
+
+    cached(1)
+    cached.cache_clear()
+    cached(1)
+
+    assert func.call_count == 2
+
+
+def test__remote_backend__shared_between_workers():
+    client = FakeRemoteClient()
+    worker_1 = MagicMock(return_value={'a': 1})
+    worker_2 = MagicMock(return_value={'b': 2})
+
+    assert _cached(RemoteCacheBackend(client), worker_1)(1) == {'a': 1}
+    assert _cached(RemoteCacheBackend(client), worker_2)(1) == {'a': 1}
+
+    worker_1.assert_called_once()
+    worker_2.assert_not_called()
+
+
+def test__remote_backend__expiry_passed_to_client():
+    client = FakeRemoteClient()
+    _cached(RemoteCacheBackend(client), MagicMock(return_value=1))(1)
+
+    assert list(client.expiries.values()) == [10]
+
+
+@pytest.mark.parametrize("expire_argument", ['expire', 'ex'])
+def test__remote_backend__expire_argument(expire_argument):
+    client = MagicMock()
+    client.get.return_value = None
+
+    _cached(RemoteCacheBackend(client, expire_argument=expire_argument), MagicMock(return_value=1))(1)
+
+    assert expire_argument in client.set.call_args.kwargs
+
+
+def test__remote_backend__cache_clear__all_workers_miss():
+    client = FakeRemoteClient()
+    worker_1 = MagicMock(return_value=1)
+    worker_2 = MagicMock(return_value=2)
+    cached_1 = _cached(RemoteCacheBackend(client), worker_1)
+    cached_2 = _cached(RemoteCacheBackend(client), worker_2)
+
+    cached_1(1)
+    cached_1.cache_clear()
+
+    assert cached_2(1) == 2
+    worker_2.assert_called_once()
+
+
+def test__sqlite_backend__maxbytes__least_recently_used_evicted(tmp_path):
+    func = MagicMock(side_effect=lambda a: 'x' * 1000)
+    cached = _cached(SqliteCacheBackend(tmp_path / 'cache.db', touch_interval=0), func, maxbytes=2500)
+
+    cached(1)
+    time.sleep(0.01)
+    cached(2)
+    time.sleep(0.01)
+    cached(1)
+    time.sleep(0.01)
+    cached(3)
+    cached(1)
+    cached(2)
+
+    assert func.call_count == 4
+    assert cached.cache_info()['size_bytes'] <= 2500
+
+
+def _accessed(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute('SELECT accessed FROM cache_entry').fetchone()[0]
+
+
+def test__sqlite_backend__hit_within_touch_interval__accessed_not_written(tmp_path):
+    path = tmp_path / 'cache.db'
+    cached = _cached(SqliteCacheBackend(path, touch_interval=60), MagicMock(return_value=1))
+
+    cached(1)
+    accessed = _accessed(path)
+    time.sleep(0.01)
+    cached(1)
+
+    assert _accessed(path) == accessed
+
+
+def test__sqlite_backend__hit_after_touch_interval__accessed_written(tmp_path):
+    path = tmp_path / 'cache.db'
+    cached = _cached(SqliteCacheBackend(path, touch_interval=0), MagicMock(return_value=1))
+
+    cached(1)
+    accessed = _accessed(path)
+    time.sleep(0.01)
+    cached(1)
+
+    assert _accessed(path) > accessed
+
+
+def test__remote_backend__version_remembered(tmp_path):
+    client = FakeRemoteClient()
+    client.get = MagicMock(wraps=client.get)
+    cached = _cached(RemoteCacheBackend(client, version_ttl=60), MagicMock(return_value=1))
+
+    for _ in range(5):
+        cached(1)
+
+    assert [c.args[0] for c in client.get.call_args_list].count('lbrc_flask:tests.shared:version') == 1
+
+
+def test__remote_backend__cache_clear__other_worker_misses_after_version_ttl():
+    client = FakeRemoteClient()
+    worker_2 = MagicMock(side_effect=[1, 2])
+    cached_1 = _cached(RemoteCacheBackend(client, version_ttl=0.1), MagicMock(return_value=1))
+    cached_2 = _cached(RemoteCacheBackend(client, version_ttl=0.1), worker_2)
+
+    cached_2(1)
+    cached_1.cache_clear()
+    time.sleep(0.15)
+
+    assert cached_2(1) == 2
+
+
+
+class SlowFirstReadBackend(CacheBackend):
+    # The first read blocks until released, like a slow shared backend
+    def __init__(self):
+        self.reading = threading.Event()
+        self.release = threading.Event()
+
+    def bind(self, namespace, maxsize, retention, maxbytes=None, sizer=None):
+        store = MemoryCacheBackend().bind(namespace, maxsize, retention)
+        get = store.get
+
+        def slow_get(key):
+            if not self.reading.is_set():
+                self.reading.set()
+                self.release.wait(5)
+
+            return get(key)
+
+        store.get = slow_get
+        return store
+
+
+def test__timed_cache__slow_backend_read__other_callers_not_blocked():
+    backend = SlowFirstReadBackend()
+    cached = timed_cache(seconds=10, backend=backend, namespace='tests.slow_read')(lambda a: a * 2)
+    slow = threading.Thread(target=cached, args=(1,))
+    slow.start()
+    backend.reading.wait(5)
+
+    try:
+        start = time.perf_counter()
+
+        assert cached(2) == 4
+        assert time.perf_counter() - start < 1
+    finally:
+        backend.release.set()
+        slow.join()
+
+
+def test__remote_backend__tag_invalidated_by_another_process__entry_missed():
+    client = FakeRemoteClient()
+    store = RemoteCacheBackend(client).bind(namespace='tests.tags.remote', maxsize=None, retention=0)
+    other_process_store = RemoteCacheBackend(client).bind(namespace='tests.tags.remote', maxsize=None, retention=0)
+
+    store.set('a', 'Red', expires=time.time() + 60, tags={('Colour', 1)})
+    store.set('b', 'Blue', expires=time.time() + 60, tags={('Colour', 2)})
+    other_process_store.delete_tagged({('Colour', 1)})
+
+    assert store.get('a') is None
+    assert store.get('b')[0] == 'Blue'
@@ -0,0 +1,68 @@
+import time
+import pytest
+from unittest.mock import MagicMock
+from flask import Flask, render_template_string
+from lbrc_flask.caching import get_cache_statistics
+from lbrc_flask.caching.fragments import init_fragment_cache, FRAGMENT_CACHE_NAME
+
+
+TEMPLATE = '''
+    {% cache 'fragment', 1 %}<b>{{ render() }}</b>{% endcache %}
+    {% cache 'other' %}{{ render() }}{% endcache %}
+'''
+
+
+@pytest.fixture(scope="function")
+def fragment_app():
+    app = Flask(__name__)
+    init_fragment_cache(app)
+
+    with app.test_request_context():
+        yield app
+
+
+def test__fragment_cache__rendered_once(fragment_app):
+    render = MagicMock(side_effect=['one', 'two', 'three'])
+
+    first = render_template_string(TEMPLATE, render=render)
+    second = render_template_string(TEMPLATE, render=render)
+
+    assert '<b>one</b>' in first
+    assert 'two' in first
+    assert first == second
+    assert render.call_count == 2
+
+
+def test__fragment_cache__expired__rendered_again(fragment_app):
+    render = MagicMock(side_effect=['one', 'two', 'three'])
+
+    render_template_string(TEMPLATE, render=render)
+    time.sleep(1.1)
+    actual = render_template_string(TEMPLATE, render=render)
+
+    assert '<b>three</b>' in actual
+    assert render.call_count == 3
+
+
+def test__fragment_cache__key_expression(fragment_app):
+    render = MagicMock(side_effect=lambda: 'x')
+    template = "{% cache ('item', item_id), 60 %}{{ render() }}{% endcache %}"
+
+    render_template_string(template, render=render, item_id=1)
+    render_template_string(template, render=render, item_id=2)
+    render_template_string(template, render=render, item_id=1)
+
+    assert render.call_count == 2
+
+
+def test__fragment_cache__statistics(fragment_app):
+    statistics = get_cache_statistics(FRAGMENT_CACHE_NAME)
+    statistics.reset()
+
+    render = MagicMock(return_value='x')
+
+    render_template_string(TEMPLATE, render=render)
+    render_template_string(TEMPLATE, render=render)
+
+    assert statistics.hits == 2
+    assert statistics.misses == 2
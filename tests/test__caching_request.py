@@ -0,0 +1,130 @@
+import pytest
+from unittest.mock import MagicMock
+from flask import Flask
+from sqlalchemy import create_engine, Integer
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session
+
+from lbrc_flask.caching import request_cached, clear_request_cache
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Thing(Base):
+    __tablename__ = 'thing'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+
+
+@pytest.fixture(scope="function")
+def plain_app():
+    app = Flask(__name__)
+    app.teardown_request(clear_request_cache)
+    app.teardown_appcontext(clear_request_cache)
+
+    yield app
+
+
+def _cached(func):
+    return request_cached()(func)
+
+
+def test__request_cached__called_twice__run_once(plain_app):
+    func = MagicMock(return_value=1)
+    cached = _cached(func)
+
+    with plain_app.test_request_context():
+        assert cached(1) == 1
+        assert cached(1) == 1
+
+    func.assert_called_once()
+
+
+def test__request_cached__different_arguments(plain_app):
+    func = MagicMock(side_effect=lambda a: a)
+    cached = _cached(func)
+
+    with plain_app.test_request_context():
+        assert cached(1) == 1
+        assert cached(2) == 2
+
+    assert func.call_count == 2
+
+
+def test__request_cached__none_result_cached(plain_app):
+    func = MagicMock(return_value=None)
+    cached = _cached(func)
+
+    with plain_app.app_context():
+        cached()
+        cached()
+
+    func.assert_called_once()
+
+
+def test__request_cached__new_request__run_again(plain_app):
+    func = MagicMock(return_value=1)
+    cached = _cached(func)
+
+    with plain_app.test_request_context():
+        cached()
+
+    with plain_app.test_request_context():
+        cached()
+
+    assert func.call_count == 2
+
+
+def test__request_cached__request_in_existing_app_context__cleared_at_teardown(plain_app):
+    func = MagicMock(return_value=1)
+    cached = _cached(func)
+
+    with plain_app.app_context():
+        with plain_app.test_request_context():
+            cached()
+
+        with plain_app.test_request_context():
+            cached()
+
+    assert func.call_count == 2
+
+
+def test__request_cached__no_app_context__always_called():
+    func = MagicMock(return_value=1)
+    cached = _cached(func)
+
+    cached()
+    cached()
+
+    assert func.call_count == 2
+
+
+def test__request_cached__unhashable_arguments__always_called(plain_app):
+    func = MagicMock(return_value=1)
+    cached = _cached(func)
+
+    with plain_app.app_context():
+        cached([1, 2])
+        cached([1, 2])
+
+    assert func.call_count == 2
+
+
+def test__request_cached__session_flushed__run_again(plain_app):
+    func = MagicMock(return_value=1)
+    cached = _cached(func)
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+
+    with plain_app.app_context(), Session(engine) as session:
+        cached()
+
+        session.add(Thing(id=1))
+        session.flush()
+
+        cached()
+        cached()
+
+    assert func.call_count == 2
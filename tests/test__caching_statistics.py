@@ -0,0 +1,34 @@
+from flask import url_for
+from flask_api import status
+from lbrc_flask.caching import timed_cache
+from lbrc_flask.pytest.helpers import login
+
+
+@timed_cache(seconds=10)
+def cached_for_statistics(a):
+    return a
+
+
+def test__cache_statistics__not_logged_in(client):
+    resp = client.get(url_for('lbrc_flask_cache_statistics'))
+    assert resp.status_code != status.HTTP_200_OK
+
+
+def test__cache_statistics__not_admin(client, faker):
+    login(client, faker)
+
+    resp = client.get(url_for('lbrc_flask_cache_statistics'))
+    assert resp.status_code == status.HTTP_403_FORBIDDEN
+
+
+def test__cache_statistics__is_admin(client, faker):
+    login(client, faker, user=faker.get_test_user(is_admin=True))
+
+    cached_for_statistics(1)
+    cached_for_statistics(1)
+
+    resp = client.get(url_for('lbrc_flask_cache_statistics'))
+    assert resp.status_code == status.HTTP_200_OK
+
+    actual = {c['name']: c for c in resp.get_json()['caches']}
+    assert actual['tests.test__caching_statistics.cached_for_statistics']['hits'] >= 1
@@ -0,0 +1,313 @@
+import sqlite3
+import subprocess
+import sys
+import textwrap
+import time
+import pytest
+from unittest.mock import MagicMock
+from sqlalchemy import create_engine, Integer, String
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session
+
+from lbrc_flask.caching import timed_cache, invalidate_cache_tags, MemoryCacheBackend, SqliteCacheBackend
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class Colour(Base):
+    __tablename__ = 'colour'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    name: Mapped[str] = mapped_column(String(50))
+
+
+class Shape(Base):
+    __tablename__ = 'shape'
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    name: Mapped[str] = mapped_column(String(50))
+
+
+@pytest.fixture(scope="function")
+def session():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+
+    with Session(engine) as session:
+        colour = Colour(id=1, name='Red')
+        session.add_all([colour, Colour(id=2, name='Blue'), Shape(id=1, name='Square')])
+        session.commit()
+
+        yield session
+
+
+def _model_cached(func):
+    return timed_cache(days=1, tags=[Colour], namespace='tests.tags.model', local_invalidation=True)(func)
+
+
+def _entry_cached(func):
+    return timed_cache(days=1, tags=lambda colour_id: [(Colour, colour_id)], namespace='tests.tags.entry', local_invalidation=True)(func)
+
+
+def test__tags__model_changed__cache_cleared(session):
+    func = MagicMock(side_effect=lambda a: a)
+    cached = _model_cached(func)
+
+    cached(1)
+    cached(2)
+
+    session.get(Colour, 1).name = 'Green'
+    session.commit()
+
+    cached(1)
+    cached(2)
+
+    assert func.call_count == 4
+
+
+def test__tags__model_added__cache_cleared(session):
+    func = MagicMock(side_effect=lambda a: a)
+    cached = _model_cached(func)
+
+    cached(1)
+
+    session.add(Colour(id=3, name='Yellow'))
+    session.commit()
+
+    cached(1)
+
+    assert func.call_count == 2
+
+
+def test__tags__model_deleted__cache_cleared(session):
+    func = MagicMock(side_effect=lambda a: a)
+    cached = _model_cached(func)
+
+    cached(1)
+
+    session.delete(session.get(Colour, 2))
+    session.commit()
+
+    cached(1)
+
+    assert func.call_count == 2
+
+
+def test__tags__other_model_changed__cache_kept(session):
+    func = MagicMock(side_effect=lambda a: a)
+    cached = _model_cached(func)
+
+    cached(1)
+
+    session.get(Shape, 1).name = 'Circle'
+    session.commit()
+
+    cached(1)
+
+    func.assert_called_once()
+
+
+def test__tags__rolled_back__cache_kept(session):
+    func = MagicMock(side_effect=lambda a: a)
+    cached = _model_cached(func)
+
+    cached(1)
+
+    session.get(Colour, 1).name = 'Green'
+    session.flush()
+    session.rollback()
+
+    cached(1)
+
+    func.assert_called_once()
+
+
+def test__tags__flushed_not_committed__cache_kept(session):
+    func = MagicMock(side_effect=lambda a: a)
+    cached = _model_cached(func)
+
+    cached(1)
+
+    session.get(Colour, 1).name = 'Green'
+    session.flush()
+
+    cached(1)
+
+    func.assert_called_once()
+
+
+def test__tags__row_changed__only_that_entry_invalidated(session):
+    func = MagicMock(side_effect=lambda a: a)
+    cached = _entry_cached(func)
+
+    cached(1)
+    cached(2)
+
+    session.get(Colour, 1).name = 'Green'
+    session.commit()
+
+    cached(1)
+    cached(2)
+
+    assert func.call_count == 3
+
+
+def test__tags__invalidate_cache_tags(session):
+    func = MagicMock(side_effect=lambda a: a)
+    cached = _entry_cached(func)
+
+    cached(1)
+    cached(2)
+
+    invalidate_cache_tags((Colour, 2))
+
+    cached(1)
+    cached(2)
+
+    assert func.call_count == 3
+
+
+def test__tags__invalidated_while_calculating__not_stored(session):
+    def change_colour(a):
+        session.get(Colour, 1).name = 'Green'
+        session.commit()
+        return a
+
+    func = MagicMock(side_effect=change_colour)
+    cached = _model_cached(func)
+
+    cached(1)
+    cached(1)
+
+    assert func.call_count == 2
+
+
+def test__tags__memory_backend__not_shared__error():
+    with pytest.raises(ValueError):
+        timed_cache(days=1, tags=[Colour], namespace='tests.tags.unshared')(lambda a: a)
+
+
+def test__tags__shared_backend__allowed(tmp_path):
+    cached = timed_cache(days=1, tags=[Colour], namespace='tests.tags.shared', backend=SqliteCacheBackend(tmp_path / 'cache.db'))(lambda a: a)
+
+    assert cached(1) == 1
+
+
+def _colour_name_cached(session, backend, namespace):
+    return timed_cache(
+        days=1,
+        tags=lambda colour_id: [(Colour, colour_id)],
+        namespace=namespace,
+        backend=backend,
+    )(lambda colour_id: session.get(Colour, colour_id).name)
+
+
+def test__tags__row_changed_by_another_process__shared_entry_invalidated(tmp_path):
+    database = tmp_path / 'models.db'
+    cache_database = tmp_path / 'cache.db'
+    engine = create_engine(f'sqlite:///{database}')
+    Base.metadata.create_all(engine)
+
+    with Session(engine) as session:
+        session.add_all([Colour(id=1, name='Red'), Colour(id=2, name='Blue')])
+        session.commit()
+
+        cached = _colour_name_cached(session, SqliteCacheBackend(cache_database), 'tests.tags.processes')
+
+        assert cached(1) == 'Red'
+        assert cached(2) == 'Blue'
+
+        subprocess.run(
+            [
+                sys.executable,
+                '-c',
+                textwrap.dedent(f'''
+                    from sqlalchemy import create_engine, Integer, String
+                    from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, Session
+                    from lbrc_flask.caching import timed_cache, SqliteCacheBackend
+
+                    class Base(DeclarativeBase):
+                        pass
+
+                    class Colour(Base):
+                        __tablename__ = 'colour'
+
+                        id: Mapped[int] = mapped_column(Integer, primary_key=True)
+                        name: Mapped[str] = mapped_column(String(50))
+
+                    timed_cache(
+                        days=1,
+                        tags=lambda colour_id: [(Colour, colour_id)],
+                        namespace='tests.tags.processes',
+                        backend=SqliteCacheBackend({str(cache_database)!r}),
+                    )(lambda colour_id: None)
+
+                    with Session(create_engine({f'sqlite:///{database}'!r})) as session:
+                        session.get(Colour, 1).name = 'Green'
+                        session.commit()
+                '''),
+            ],
+            check=True,
+        )
+
+        session.expire_all()
+
+        assert cached(1) == 'Green'
+        assert cached(2) == 'Blue'
+
+
+@pytest.mark.parametrize("backend", ['memory', 'sqlite'])
+def test__tags__store__delete_tagged(tmp_path, backend):
+    if backend == 'memory':
+        store = MemoryCacheBackend().bind(namespace='tests.tags.store', maxsize=None, retention=0)
+    else:
+        store = SqliteCacheBackend(tmp_path / 'cache.db').bind(namespace='tests.tags.store', maxsize=None, retention=0)
+
+    expires = time.time() + 60
+    store.set('a', 1, expires, tags={('Colour', 1)})
+    store.set('b', 2, expires, tags={('Colour', 2)})
+    store.set('c', 3, expires, tags={('Colour', 1), ('Colour', 2)})
+    store.set('c', 3, expires, tags={('Colour', 2)})
+
+    store.delete_tagged({('Colour', 1)})
+
+    assert store.get('a') is None
+    assert store.get('b') is not None
+    assert store.get('c') is not None
+
+
+def test__tags__memory_store__evicted__tags_dropped():
+    store = MemoryCacheBackend().bind(namespace='tests.tags.evicted', maxsize=2, retention=0)
+
+    for i in range(10):
+        store.set(i, i, time.time() + 60, tags={('Colour', i)})
+
+    assert set(store._tag_keys) == {('Colour', 8), ('Colour', 9)}
+
+
+def test__tags__sqlite_store__evicted__tags_dropped(tmp_path):
+    path = tmp_path / 'cache.db'
+    store = SqliteCacheBackend(path).bind(namespace='tests.tags.evicted', maxsize=2, retention=0)
+
+    for i in range(10):
+        store.set(str(i), i, time.time() + 60, tags={('Colour', i)})
+        time.sleep(0.001)
+
+    with sqlite3.connect(path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM cache_tag').fetchone()[0] == 2
+
+
+def test__tags__row_invalidated_while_calculating__not_stored(session):
+    def change_colour(colour_id):
+        session.get(Colour, colour_id).name = 'Green'
+        session.commit()
+        return colour_id
+
+    func = MagicMock(side_effect=change_colour)
+    cached = _entry_cached(func)
+
+    cached(1)
+    cached(1)
+
+    assert func.call_count == 2
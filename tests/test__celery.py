@@ -0,0 +1,124 @@
+import threading
+import pytest
+from celery import Celery
+from flask import Flask, g
+from lbrc_flask.celery import _context_task, _worker
+from lbrc_flask.database import db
+
+
+@pytest.fixture(scope="function")
+def celery_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['CELERY_RATE_LIMIT'] = ''
+    db.init_app(app)
+
+    return app
+
+
+def task_for(app, reuse_app_context):
+    app.config['CELERY_REUSE_APP_CONTEXT'] = reuse_app_context
+
+    test_celery = Celery()
+    test_celery.Task = _context_task(test_celery.Task, app)
+
+    @test_celery.task()
+    def task(fail=False):
+        result = {
+            'app_context': g._get_current_object(),
+            'previous': g.get('value'),
+            'session': db.session(),
+        }
+
+        g.value = 'set'
+
+        if fail:
+            raise ValueError('Broken')
+
+        return result
+
+    return task
+
+
+def in_worker_thread(f):
+    # A new thread starts without an app context, as a worker does
+    result = {}
+
+    thread = threading.Thread(target=lambda: result.update(value=f()))
+    thread.start()
+    thread.join()
+
+    return result['value']
+
+
+def test__context_task__new_context_per_task(celery_app):
+    task = task_for(celery_app, reuse_app_context=False)
+
+    first, second = in_worker_thread(lambda: [task(), task()])
+
+    assert first['app_context'] is not second['app_context']
+    assert second['previous'] is None
+
+
+def test__context_task__reuse_app_context__g_and_session_reset(celery_app):
+    task = task_for(celery_app, reuse_app_context=True)
+
+    def run():
+        first = task()
+        first_context = _worker.app_context
+        second = task()
+
+        return first, second, first_context is _worker.app_context, g.get('value')
+
+    first, second, same_context, left = in_worker_thread(run)
+
+    assert same_context
+    assert second['previous'] is None
+    assert first['session'] is not second['session']
+    assert left is None
+
+
+def test__context_task__reuse_app_context__failed_task__reset(celery_app):
+    task = task_for(celery_app, reuse_app_context=True)
+
+    def run():
+        with pytest.raises(ValueError):
+            task(fail=True)
+
+        return task()
+
+    assert in_worker_thread(run)['previous'] is None
+
+
+def test__context_task__reuse_app_context__inside_other_context(celery_app):
+    task = task_for(celery_app, reuse_app_context=True)
+
+    with celery_app.app_context():
+        g.value = 'outer'
+
+        actual = task()
+
+        assert g.value == 'outer'
+
+    assert actual['previous'] is None
+
+
+def test__context_task__reuse_app_context__nested_task__outer_context_kept(celery_app):
+    task = task_for(celery_app, reuse_app_context=True)
+    outer_celery = Celery()
+    outer_celery.Task = _context_task(outer_celery.Task, celery_app)
+
+    @outer_celery.task()
+    def outer():
+        g.value = 'outer'
+        session = db.session()
+
+        inner = task()
+
+        return g.get('value'), db.session() is session, inner['previous']
+
+    value, same_session, inner_previous = in_worker_thread(lambda: outer())
+
+    assert value == 'outer'
+    assert same_session
+    assert inner_previous is None
@@ -0,0 +1,141 @@
+import datetime
+import pytest
+from unittest.mock import MagicMock
+from flask import Flask
+from lbrc_flask.database import db
+from lbrc_flask.response import conditional_get, audit_validator
+
+
+class ConditionalThing(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    last_update_date = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+@pytest.fixture(scope="function")
+def conditional_app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+
+    app.config['render'] = render = MagicMock(return_value='Hello')
+    app.config['version'] = version = MagicMock(return_value=1)
+
+    @app.route('/etag')
+    @conditional_get(etag=lambda: version())
+    def etag():
+        return render()
+
+    @app.route('/last_modified')
+    @conditional_get(last_modified=lambda: datetime.datetime(2024, 1, 2, 3, 4, 5))
+    def last_modified():
+        return render()
+
+    @app.route('/content', methods=['GET', 'POST'])
+    @conditional_get(max_age=60)
+    def content():
+        return render()
+
+    @app.route('/things')
+    @conditional_get(etag=lambda: audit_validator(ConditionalThing))
+    def things():
+        return render()
+
+    with app.app_context():
+        db.create_all()
+        yield app
+
+
+def test__conditional_get__etag__not_modified(conditional_app):
+    client = conditional_app.test_client()
+
+    first = client.get('/etag')
+    second = client.get('/etag', headers={'If-None-Match': first.headers['ETag']})
+
+    assert first.status_code == 200
+    assert second.status_code == 304
+    assert second.headers['ETag'] == first.headers['ETag']
+    conditional_app.config['render'].assert_called_once()
+
+
+def test__conditional_get__etag__modified(conditional_app):
+    client = conditional_app.test_client()
+
+    first = client.get('/etag')
+    conditional_app.config['version'].return_value = 2
+    second = client.get('/etag', headers={'If-None-Match': first.headers['ETag']})
+
+    assert second.status_code == 200
+    assert second.headers['ETag'] != first.headers['ETag']
+
+
+def test__conditional_get__cache_control(conditional_app):
+    resp = conditional_app.test_client().get('/etag')
+
+    assert resp.cache_control.private
+    assert resp.cache_control.no_cache
+    assert resp.cache_control.max_age == 0
+    assert 'HX-Request' in resp.vary
+
+
+def test__conditional_get__htmx_request__different_etag(conditional_app):
+    client = conditional_app.test_client()
+
+    page = client.get('/etag')
+    partial = client.get('/etag', headers={'HX-Request': 'true'})
+
+    assert page.headers['ETag'] != partial.headers['ETag']
+
+
+def test__conditional_get__last_modified__not_modified(conditional_app):
+    client = conditional_app.test_client()
+
+    first = client.get('/last_modified')
+    second = client.get('/last_modified', headers={'If-Modified-Since': first.headers['Last-Modified']})
+
+    assert first.headers['Last-Modified'] == 'Tue, 02 Jan 2024 03:04:05 GMT'
+    assert second.status_code == 304
+    conditional_app.config['render'].assert_called_once()
+
+
+def test__conditional_get__last_modified__modified(conditional_app):
+    resp = conditional_app.test_client().get('/last_modified', headers={'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+
+    assert resp.status_code == 200
+
+
+def test__conditional_get__content_hash__not_modified(conditional_app):
+    client = conditional_app.test_client()
+
+    first = client.get('/content')
+    second = client.get('/content', headers={'If-None-Match': first.headers['ETag']})
+
+    assert second.status_code == 304
+    assert first.cache_control.max_age == 60
+
+
+def test__conditional_get__post__not_cached(conditional_app):
+    resp = conditional_app.test_client().post('/content')
+
+    assert resp.status_code == 200
+    assert 'ETag' not in resp.headers
+
+
+def test__conditional_get__audit_validator__changes_with_rows(conditional_app):
+    client = conditional_app.test_client()
+
+    first = client.get('/things')
+
+    db.session.add(ConditionalThing(id=1))
+    db.session.commit()
+
+    second = client.get('/things', headers={'If-None-Match': first.headers['ETag']})
+    third = client.get('/things', headers={'If-None-Match': second.headers['ETag']})
+
+    db.session.delete(db.session.get(ConditionalThing, 1))
+    db.session.commit()
+
+    fourth = client.get('/things', headers={'If-None-Match': second.headers['ETag']})
+
+    assert second.status_code == 200
+    assert third.status_code == 304
+    assert fourth.status_code == 200